@@ -0,0 +1,97 @@
+import json
+import time
+from typing import TextIO
+
+from ansible.executor.task_result import TaskResult
+from ansible.inventory.host import Host
+from ansible.playbook.task import Task
+from ansible.plugins.callback import CallbackBase
+
+# ruff: noqa: SLF001
+
+DOCUMENTATION = """
+name: pi_server_profile
+type: aggregate
+short_description: Records when each task started and finished on each host
+description:
+  - Writes a JSON object per line for each task run on each host, with its start and end
+    times and the stack of roles that included it. Read the log with
+    'utils/roles.py profile'.
+options:
+  log_path:
+    description: File to write the log to; overwritten on each run.
+    default: ansible-profile.log
+    type: path
+    env:
+      - name: PI_SERVER_PROFILE_LOG
+    ini:
+      - section: callback_pi_server_profile
+        key: log_path
+"""
+
+
+def _role_stack(task: Task) -> list[str]:
+    """Names of the roles that dynamically included task, outermost first."""
+    stack: list[str] = []
+    node: object = task
+    while node is not None:
+        role = getattr(node, "_role", None)
+        if role is not None:
+            name = role.get_name()
+            if not stack or stack[-1] != name:
+                stack.append(name)
+        node = getattr(node, "_parent", None)
+    return stack[::-1]
+
+
+class CallbackModule(CallbackBase):
+    CALLBACK_VERSION = 2.0
+    CALLBACK_TYPE = "aggregate"
+    CALLBACK_NAME = "pi_server_profile"
+    CALLBACK_NEEDS_ENABLED = True
+
+    def __init__(self) -> None:
+        super().__init__()
+        self._log: TextIO | None = None
+        self._starts: dict[tuple[str, str], float] = {}
+
+    def v2_playbook_on_start(self, playbook: object) -> None:  # noqa: ARG002
+        self._log = open(self.get_option("log_path"), "w", encoding="utf-8", buffering=1)  # noqa: SIM115
+
+    def v2_runner_on_start(self, host: Host, task: Task) -> None:
+        self._starts[(host.get_name(), task._uuid)] = time.time()
+
+    def _record(self, result: TaskResult, status: str) -> None:
+        end = time.time()
+        host = result._host.get_name()
+        task = result._task
+        start = self._starts.pop((host, task._uuid), end)
+        if self._log is not None:
+            record = {
+                "host": host,
+                "task": task.name or task.action,
+                "action": task.action,
+                "path": task.get_path(),
+                "roles": _role_stack(task),
+                "start": start,
+                "end": end,
+                "status": status,
+            }
+            self._log.write(json.dumps(record) + "\n")
+
+    def v2_runner_on_ok(self, result: TaskResult) -> None:
+        self._record(result, "ok")
+
+    def v2_runner_on_failed(self, result: TaskResult, ignore_errors: bool = False) -> None:  # noqa: ARG002
+        self._record(result, "failed")
+
+    def v2_runner_on_skipped(self, result: TaskResult) -> None:
+        self._record(result, "skipped")
+
+    def v2_runner_on_unreachable(self, result: TaskResult) -> None:
+        self._record(result, "unreachable")
+
+    def v2_playbook_on_stats(self, stats: object) -> None:  # noqa: ARG002
+        if self._log is not None:
+            self._log.close()
+            self._log = None
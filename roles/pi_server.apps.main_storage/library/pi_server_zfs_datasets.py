@@ -0,0 +1,139 @@
+from typing import Any
+
+from ansible.module_utils.basic import AnsibleModule
+
+DOCUMENTATION = r"""
+module: pi_server_zfs_datasets
+short_description: Ensure datasets exist in a zpool, with the given mountpoints and properties
+description:
+  - Inspects the pool and all its datasets with a single 'zfs list', then creates missing datasets
+    and sets properties that differ, so adding datasets doesn't add round trips.
+  - Mountpoints are checked, not changed; moving a dataset that already holds data is left to a
+    human.
+options:
+  pool:
+    description: Name of the zpool, which must already exist.
+    type: str
+    required: true
+  mountpoint:
+    description: Where the pool must be mounted.
+    type: str
+    required: true
+  datasets:
+    description:
+      - Datasets to ensure, parents before children. 'name' is relative to the pool, 'mountpoint'
+        is where the dataset must end up mounted, and 'properties' (other than mountpoint) are
+        set on it.
+      - Property values are compared as 'zfs list' prints them, e.g. '10G' not '10737418240'.
+        Booleans, such as YAML's unquoted 'on', become 'on' or 'off'.
+    type: list
+    elements: dict
+    default: []
+"""
+
+RETURN = r"""
+datasets:
+  description: Mountpoint of each dataset, by full name.
+  type: dict
+  returned: always
+"""
+
+
+def _zfs_list(module: AnsibleModule, pool: str, properties: list[str]) -> dict[str, dict[str, str]]:
+    """Properties of the pool and every dataset in it, by full name."""
+    columns = ["name", "mountpoint", *properties]
+    rc, stdout, stderr = module.run_command(
+        ["zfs", "list", "-H", "-r", "-t", "filesystem", "-o", ",".join(columns), pool],
+    )
+    if rc != 0:
+        module.fail_json(msg=f"Couldn't list zpool '{pool}': {stderr.strip()}")
+    out = {}
+    for line in stdout.splitlines():
+        values = line.split("\t")
+        out[values[0]] = dict(zip(columns[1:], values[1:], strict=True))
+    return out
+
+
+def _zfs_value(value: object) -> str:
+    if isinstance(value, bool):
+        return "on" if value else "off"
+    return str(value)
+
+
+def _parent(name: str) -> str:
+    return name.rsplit("/", 1)[0]
+
+
+def main() -> None:
+    module = AnsibleModule(
+        argument_spec={
+            "pool": {"type": "str", "required": True},
+            "mountpoint": {"type": "str", "required": True},
+            "datasets": {
+                "type": "list",
+                "elements": "dict",
+                "default": [],
+                "options": {
+                    "name": {"type": "str", "required": True},
+                    "mountpoint": {"type": "str", "required": True},
+                    "properties": {"type": "dict", "default": {}},
+                },
+            },
+        },
+        supports_check_mode=True,
+    )
+    pool: str = module.params["pool"]
+    datasets: list[dict[str, Any]] = module.params["datasets"]
+
+    properties = sorted({k for d in datasets for k in d["properties"]})
+    if "mountpoint" in properties:
+        module.fail_json(msg="Set a dataset's 'mountpoint' option, not a mountpoint property")
+    existing = _zfs_list(module, pool, properties)
+    if existing[pool]["mountpoint"] != module.params["mountpoint"]:
+        module.fail_json(
+            msg=f"zpool '{pool}' isn't mounted at '{module.params['mountpoint']}'",
+        )
+
+    # Work out every change before making any, so a bad mountpoint changes nothing
+    mountpoints = {name: values["mountpoint"] for name, values in existing.items()}
+    commands: list[list[str]] = []
+    before: dict[str, Any] = {}
+    after: dict[str, Any] = {}
+    for d in datasets:
+        name = f"{pool}/{d['name']}"
+        wanted = {k: _zfs_value(v) for k, v in d["properties"].items()}
+        if name in existing:
+            current = existing[name]
+            changed = {k: v for k, v in wanted.items() if current.get(k) != v}
+            if changed:
+                before[name] = {k: current.get(k) for k in changed}
+                after[name] = changed
+                commands.extend(["zfs", "set", f"{k}={v}", name] for k, v in changed.items())
+        else:
+            parent = _parent(name)
+            if parent not in mountpoints:
+                module.fail_json(msg=f"dataset '{parent}' doesn't exist, so can't create '{name}'")
+            # New datasets inherit their mountpoint
+            mountpoints[name] = f"{mountpoints[parent]}/{name.rsplit('/', 1)[1]}"
+            before[name] = None
+            after[name] = wanted
+            options = [a for k, v in wanted.items() for a in ("-o", f"{k}={v}")]
+            commands.append(["zfs", "create", *options, name])
+        if mountpoints[name] != d["mountpoint"]:
+            module.fail_json(msg=f"dataset '{name}' isn't mounted at '{d['mountpoint']}'")
+
+    if not module.check_mode:
+        for command in commands:
+            module.run_command(command, check_rc=True)
+
+    result: dict[str, Any] = {
+        "changed": bool(commands),
+        "datasets": {f"{pool}/{d['name']}": mountpoints[f"{pool}/{d['name']}"] for d in datasets},
+    }
+    if module._diff:  # noqa: SLF001
+        result["diff"] = {"before": before, "after": after}
+    module.exit_json(**result)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,144 @@
+import re
+import tempfile
+import xml.etree.ElementTree as ET
+from pathlib import Path
+from typing import Any
+
+from ansible.module_utils.basic import AnsibleModule
+
+DOCUMENTATION = r"""
+module: pi_server_xml_settings
+short_description: Set many values in an XML file with one parse and one write
+description:
+  - Each setting is a path to an element, whose text is set, or to an attribute ending in
+    '/@name', whose value is set. Paths are absolute and made of plain tag names; missing
+    elements are created.
+  - The file is only rewritten if something changed, and the keys that changed are returned.
+    Comments are kept, and only new elements are indented; the rest keeps its layout.
+options:
+  path:
+    description: The XML file, which must exist.
+    type: path
+    required: true
+  settings:
+    description: Value of each path, e.g. '/configuration/options/startBrowser' or
+      '/configuration/gui/@tls'. Booleans become 'true' or 'false', as Syncthing writes them.
+    type: dict
+    required: true
+"""
+
+RETURN = r"""
+changed_keys:
+  description: The paths whose values changed.
+  type: list
+  elements: str
+  returned: always
+"""
+
+STEP = re.compile(r"[A-Za-z_][\w.-]*")
+INDENT = "    "
+
+
+def _find(
+    module: AnsibleModule,
+    root: ET.Element,
+    key: str,
+) -> tuple[ET.Element | None, list[str], str]:
+    """The element a key refers to if it exists, the steps to it, and its attribute if any."""
+    element_path, _, attribute = key.partition("/@")
+    steps = element_path.split("/")
+    if not key.startswith("/") or not all(STEP.fullmatch(s) for s in steps[1:]):
+        module.fail_json(msg=f"'{key}' isn't an absolute path of plain tag names")
+    if steps[1] != root.tag:
+        module.fail_json(msg=f"'{key}' doesn't start at the root element '{root.tag}'")
+    element = root.find("/".join(steps[2:])) if steps[2:] else root
+    return element, steps[2:], attribute
+
+
+def _xml_value(value: object) -> str:
+    if isinstance(value, bool):
+        return "true" if value else "false"
+    return str(value)
+
+
+def _append(parent: ET.Element, tag: str, depth: int) -> ET.Element:
+    """Adds a child at the end of parent, which is depth below the root, indented to match."""
+    child_tail = "\n" + INDENT * depth
+    if len(parent):
+        last = parent[-1]
+        child_tail = last.tail or child_tail
+        last.tail = "\n" + INDENT * (depth + 1)
+    elif not (parent.text or "").strip():
+        parent.text = "\n" + INDENT * (depth + 1)
+    child = ET.SubElement(parent, tag)
+    child.tail = child_tail
+    return child
+
+
+def main() -> None:
+    module = AnsibleModule(
+        argument_spec={
+            "path": {"type": "path", "required": True},
+            "settings": {"type": "dict", "required": True},
+        },
+        supports_check_mode=True,
+    )
+    path = Path(module.params["path"])
+    settings = {k: _xml_value(v) for k, v in module.params["settings"].items()}
+
+    try:
+        text = path.read_text(encoding="utf-8")
+        parser = ET.XMLParser(target=ET.TreeBuilder(insert_comments=True, insert_pis=True))
+        root = ET.fromstring(text, parser=parser)
+    except (OSError, ET.ParseError) as e:
+        module.fail_json(msg=f"Can't read '{path}': {e}")
+
+    before: dict[str, str | None] = {}
+    after: dict[str, str] = {}
+    for key, value in settings.items():
+        element, steps, attribute = _find(module, root, key)
+        if element is None:
+            current = None
+            element = root
+            for depth, step in enumerate(steps):
+                child = element.find(step)
+                element = _append(element, step, depth) if child is None else child
+        else:
+            current = element.get(attribute) if attribute else element.text
+        if current == value:
+            continue
+        if attribute:
+            element.set(attribute, value)
+        else:
+            element.text = value
+        before[key] = current
+        after[key] = value
+
+    if after and not module.check_mode:
+        declaration = re.match(r"\s*<\?xml[^>]*\?>\s*", text)
+        # Syncthing writes empty elements in full, too
+        output = (declaration.group(0) if declaration else "") + ET.tostring(
+            root,
+            encoding="unicode",
+            short_empty_elements=False,
+        )
+        if text.endswith("\n"):
+            output += "\n"
+        with tempfile.NamedTemporaryFile(
+            "w",
+            encoding="utf-8",
+            dir=module.tmpdir,
+            delete=False,
+        ) as f:
+            f.write(output)
+        # Keeps the file's owner and mode
+        module.atomic_move(f.name, str(path))
+
+    result: dict[str, Any] = {"changed": bool(after), "changed_keys": sorted(after)}
+    if module._diff:  # noqa: SLF001
+        result["diff"] = {"before": before, "after": after}
+    module.exit_json(**result)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,121 @@
+from typing import Any
+
+from ansible.errors import AnsibleActionFail, AnsibleUndefinedVariable
+from ansible.module_utils.parsing.convert_bool import boolean
+from ansible.plugins.action import ActionBase
+
+# ruff: noqa: ANN401
+
+CALL_STACK = "_pi_server_role_helpers_call_stack"
+INITIAL_FRAME: dict[str, Any] = {"name": "", "args": {}}
+
+
+def _prefix(name: str) -> str:
+    return ".".join(name.split(".")[:-1])
+
+
+class ActionModule(ActionBase):
+    """The bookkeeping done before and after a role's tasks, as one task each.
+
+    'enter' validates args and host vars, saves arg values, pushes a stack frame and checks
+    whether a private role may be called. 'exit' pops the frame, clears the saved args, exports
+    vars and marks the role as done. The results are returned as 'vars', for set_fact to apply:
+    returning them as facts would put them in the fact cache, below play and role vars.
+    """
+
+    TRANSFERS_FILES = False
+    _VALID_ARGS = frozenset(
+        ("phase", "private", "args", "host_vars", "export_vars"),
+    )
+    _requires_connection = False
+
+    def run(
+        self,
+        tmp: str | None = None,
+        task_vars: dict[str, Any] | None = None,
+    ) -> dict[str, Any]:
+        if task_vars is None:
+            task_vars = {}
+        result = super().run(tmp, task_vars)
+        del tmp  # tmp no longer has any effect
+
+        role_name = task_vars["role_name"]
+        tidy_name = role_name.replace(".", "_")
+        phase = self._task.args.get("phase")
+        if phase == "enter":
+            role_vars = self._enter(task_vars, role_name, tidy_name)
+        elif phase == "exit":
+            role_vars = self._exit(task_vars, tidy_name)
+        else:
+            raise AnsibleActionFail(f"Unknown phase '{phase}'; must be 'enter' or 'exit'")
+
+        result["changed"] = False
+        result["vars"] = role_vars
+        return result
+
+    def _lookup(self, task_vars: dict[str, Any], name: str) -> Any:
+        """Like lookup('vars', name); raises AnsibleUndefinedVariable if undefined."""
+        self._templar.available_variables = task_vars
+        if name in task_vars:
+            value = task_vars[name]
+        else:
+            try:
+                value = task_vars["hostvars"][task_vars["inventory_hostname"]][name]
+            except KeyError:
+                msg = f"No variable found with this name: {name}"
+                raise AnsibleUndefinedVariable(msg) from None
+        return self._templar.template(value, fail_on_undefined=True)
+
+    def _evaluate(
+        self,
+        task_vars: dict[str, Any],
+        names: list[str],
+    ) -> tuple[dict[str, Any], list[str]]:
+        """Values of the named vars, and the names of any that are undefined."""
+        values = {}
+        missing = []
+        for name in names:
+            try:
+                values[name] = self._lookup(task_vars, name)
+            except AnsibleUndefinedVariable:  # noqa: PERF203
+                missing.append(name)
+        return values, missing
+
+    def _enter(self, task_vars: dict[str, Any], role_name: str, tidy_name: str) -> dict[str, Any]:
+        args: list[str] = self._task.args.get("args", [])
+        host_vars: list[str] = self._task.args.get("host_vars", [])
+        private = boolean(self._task.args.get("private", False), strict=False)
+
+        # Saving arg values forces strict evaluation, which works around ansible not making
+        # variables from higher up the role call stack available further down it.
+        arg_values, missing_args = self._evaluate(task_vars, args)
+        errors = [f"Expected arg '{name}' is not set" for name in missing_args]
+        errors.extend(
+            f"Expected host var '{name}' is not set; set it in your inventory"
+            for name in self._evaluate(task_vars, host_vars)[1]
+        )
+        if errors:
+            raise AnsibleActionFail("; ".join(errors))
+
+        stack = list(task_vars.get(CALL_STACK) or [INITIAL_FRAME])
+        caller_name = stack[-1]["name"]
+        stack.append({"name": role_name, "args": arg_values})
+
+        allowed_prefix = _prefix(role_name)
+        if private and _prefix(caller_name) != allowed_prefix and caller_name != allowed_prefix:
+            raise AnsibleActionFail("Role is marked private, and may not be called here")
+
+        return {f"{tidy_name}_args": arg_values, CALL_STACK: stack}
+
+    def _exit(self, task_vars: dict[str, Any], tidy_name: str) -> dict[str, Any]:
+        export_vars: list[str] = self._task.args.get("export_vars", [])
+        role_vars: dict[str, Any] = {
+            CALL_STACK: list(self._lookup(task_vars, CALL_STACK))[:-1],
+            f"{tidy_name}_args": {},
+        }
+        # Exports see the stack already popped, as they did when this was done with set_fact
+        exit_vars = {**task_vars, **role_vars}
+        for name in export_vars:
+            role_vars[name] = self._lookup(exit_vars, name)
+        role_vars[f"_{tidy_name}_done"] = True
+        return role_vars
@@ -0,0 +1,87 @@
+import os
+import stat
+
+from ansible.module_utils.basic import AnsibleModule
+
+DOCUMENTATION = r"""
+module: pi_server_tree_modes
+short_description: Set the mode of every dir and file under a path, in one pass
+description:
+  - Walks the tree once and only chmods entries whose mode differs, rather than running find and
+    chmod per file. Symlinks are left alone.
+  - Like symbolic modes in GNU chmod (e.g. 'u=rwx,go=rx'), dirs keep their setuid and setgid
+    bits; every other bit is set from the mode.
+options:
+  path:
+    description: Root of the tree; it is included.
+    type: path
+    required: true
+  dir_mode:
+    description: Octal mode for dirs.
+    type: str
+    default: '0755'
+  file_mode:
+    description: Octal mode for regular files.
+    type: str
+    default: '0644'
+"""
+
+RETURN = r"""
+changed_paths:
+  description: Paths whose mode was changed.
+  type: list
+  elements: str
+  returned: always
+"""
+
+
+def _walk(path: str) -> list[tuple[str, os.stat_result]]:
+    """Every entry under path, and path itself, with its lstat."""
+    out = [(path, os.lstat(path))]
+    stack = [path] if stat.S_ISDIR(out[0][1].st_mode) else []
+    while stack:
+        with os.scandir(stack.pop()) as entries:
+            for entry in entries:
+                st = entry.stat(follow_symlinks=False)
+                out.append((entry.path, st))
+                if stat.S_ISDIR(st.st_mode):
+                    stack.append(entry.path)
+    return out
+
+
+def main() -> None:
+    module = AnsibleModule(
+        argument_spec={
+            "path": {"type": "path", "required": True},
+            "dir_mode": {"type": "str", "default": "0755"},
+            "file_mode": {"type": "str", "default": "0644"},
+        },
+        supports_check_mode=True,
+    )
+    try:
+        dir_mode = int(module.params["dir_mode"], 8)
+        file_mode = int(module.params["file_mode"], 8)
+    except ValueError as e:
+        module.fail_json(msg=f"Modes must be octal: {e}")
+
+    changed = []
+    try:
+        for path, st in _walk(module.params["path"]):
+            if stat.S_ISDIR(st.st_mode):
+                mode = dir_mode | (st.st_mode & (stat.S_ISUID | stat.S_ISGID))
+            elif stat.S_ISREG(st.st_mode):
+                mode = file_mode
+            else:
+                continue
+            if stat.S_IMODE(st.st_mode) != mode:
+                changed.append(path)
+                if not module.check_mode:
+                    os.chmod(path, mode)
+    except OSError as e:
+        module.fail_json(msg=str(e))
+
+    module.exit_json(changed=bool(changed), changed_paths=sorted(changed))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,4 @@
+from typing import Any
+
+class Config:
+    def getoption(self, name: str) -> Any: ...  # noqa: ANN401
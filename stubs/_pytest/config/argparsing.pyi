@@ -0,0 +1,4 @@
+from typing import Any
+
+class Parser:
+    def addoption(self, *opts: str, **attrs: Any) -> None: ...  # noqa: ANN401
@@ -1,4 +1,12 @@
+from typing import Any
+
+from _pytest.config import Config
 from _pytest.mark import structures
+from _pytest.nodes import Node
 
 class FixtureRequest:
     keywords: dict[str, list[structures.Mark]]
+    config: Config
+    node: Node
+    fixturenames: list[str]
+    def getfixturevalue(self, argname: str) -> Any: ...  # noqa: ANN401
@@ -0,0 +1,5 @@
+from _pytest.config import Config
+
+class Session:
+    config: Config
+    exitstatus: int
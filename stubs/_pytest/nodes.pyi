@@ -0,0 +1,10 @@
+from _pytest.mark.structures import Mark, MarkDecorator
+
+class Node:
+    parent: Node | None
+    def get_closest_marker(self, name: str) -> Mark | None: ...
+    def add_marker(self, marker: MarkDecorator) -> None: ...
+
+class Item(Node):
+    nodeid: str
+    user_properties: list[tuple[str, object]]
@@ -1,6 +1,13 @@
 from collections.abc import Sequence
 
 from _pytest.mark.structures import Mark
+from _pytest.nodes import Item
+
+class CallSpec2:
+    params: dict[str, object]
+
+class Function(Item):
+    callspec: CallSpec2
 
 class FunctionDefinition:
     def get_closest_marker(self, name: str) -> Mark | None: ...
@@ -0,0 +1,6 @@
+class TestReport:
+    nodeid: str
+    when: str
+    duration: float
+    passed: bool
+    user_properties: list[tuple[str, object]]
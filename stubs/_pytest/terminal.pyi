@@ -0,0 +1,6 @@
+from _pytest.config import Config
+
+class TerminalReporter:
+    config: Config
+    def section(self, title: str) -> None: ...
+    def write_line(self, line: str) -> None: ...
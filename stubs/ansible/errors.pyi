@@ -0,0 +1,7 @@
+# ruff: noqa: N818
+
+class AnsibleError(Exception):
+    def __init__(self, message: str = "") -> None: ...
+
+class AnsibleActionFail(AnsibleError): ...
+class AnsibleUndefinedVariable(AnsibleError): ...
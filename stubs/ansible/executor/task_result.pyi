@@ -0,0 +1,6 @@
+from ansible.inventory.host import Host
+from ansible.playbook.task import Task
+
+class TaskResult:
+    _host: Host
+    _task: Task
@@ -0,0 +1,2 @@
+class Host:
+    def get_name(self) -> str: ...
@@ -0,0 +1,23 @@
+from collections.abc import Sequence
+from typing import Any, NoReturn
+
+# ruff: noqa: ANN401
+
+class AnsibleModule:
+    params: dict[str, Any]
+    check_mode: bool
+    _diff: bool
+    tmpdir: str
+    def __init__(
+        self,
+        argument_spec: dict[str, Any],
+        supports_check_mode: bool = False,
+    ) -> None: ...
+    def run_command(
+        self,
+        args: str | Sequence[str],
+        check_rc: bool = False,
+    ) -> tuple[int, str, str]: ...
+    def atomic_move(self, src: str, dest: str) -> None: ...
+    def fail_json(self, msg: str, **kwargs: Any) -> NoReturn: ...
+    def exit_json(self, **kwargs: Any) -> NoReturn: ...
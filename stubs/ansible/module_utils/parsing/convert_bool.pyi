@@ -0,0 +1 @@
+def boolean(value: object, strict: bool = True) -> bool: ...
@@ -0,0 +1,2 @@
+class Role:
+    def get_name(self) -> str: ...
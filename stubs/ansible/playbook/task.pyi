@@ -0,0 +1,13 @@
+from typing import Any
+
+from ansible.playbook.role import Role
+
+class Task:
+    _uuid: str
+    _role: Role | None
+    _parent: object
+    name: str
+    action: str
+    args: dict[str, Any]
+    def get_name(self) -> str: ...
+    def get_path(self) -> str: ...
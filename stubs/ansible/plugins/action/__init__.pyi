@@ -0,0 +1,18 @@
+from typing import Any
+
+from ansible.playbook.task import Task
+from ansible.template import Templar
+
+# ruff: noqa: ANN401
+
+class ActionBase:
+    TRANSFERS_FILES: bool
+    _VALID_ARGS: frozenset[str]
+    _requires_connection: bool
+    _task: Task
+    _templar: Templar
+    def run(
+        self,
+        tmp: str | None = None,
+        task_vars: dict[str, Any] | None = None,
+    ) -> dict[str, Any]: ...
@@ -0,0 +1,7 @@
+from typing import Any
+
+# ruff: noqa: ANN401
+
+class CallbackBase:
+    def __init__(self) -> None: ...
+    def get_option(self, k: str) -> Any: ...
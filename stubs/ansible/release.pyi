@@ -0,0 +1 @@
+__version__: str
@@ -0,0 +1,25 @@
+from typing import Any
+
+from ansible.parsing.dataloader import DataLoader
+from jinja2 import Environment
+
+# ruff: noqa: ANN401
+
+class Templar:
+    available_variables: dict[str, Any]
+    environment: Environment
+    def __init__(
+        self,
+        loader: DataLoader | None,
+        variables: dict[str, Any] | None = None,
+    ) -> None: ...
+    def template(
+        self,
+        variable: Any,
+        preserve_trailing_newlines: bool = True,
+        escape_backslashes: bool = True,
+        fail_on_undefined: bool | None = None,
+        convert_data: bool = True,
+    ) -> Any: ...
+
+def generate_ansible_template_vars(path: str) -> dict[str, Any]: ...
@@ -1,4 +1,5 @@
 from collections.abc import Callable
+from enum import IntEnum
 from typing import Any, TypeVar
 
 from _pytest.mark import structures
@@ -9,3 +10,12 @@ mark: structures.MarkGenerator
 
 def fixture(scope: str = "function", autouse: bool = False) -> Callable[[_F], _F]: ...
 def fail(msg: str) -> None: ...
+def hookimpl(
+    hookwrapper: bool = False,
+    tryfirst: bool = False,
+    trylast: bool = False,
+) -> Callable[[_F], _F]: ...
+
+class ExitCode(IntEnum):
+    OK = 0
+    TESTS_FAILED = 1
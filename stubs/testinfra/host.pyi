@@ -3,7 +3,7 @@ from collections.abc import Sequence
 from contextlib import AbstractContextManager
 from typing import Any
 
-from helpers import CronRunner, Journal, ShadowDir, ShadowFile, Time
+from helpers import Batch, CronRunner, Journal, ShadowDir, ShadowFile, ShadowFiles, Time
 
 from testinfra.backend.base import CommandResult
 from testinfra.modules.addr import Addr
@@ -25,7 +25,9 @@ class Host:
     def check_output(self, command: str, *args: Any) -> str: ...
     def file(self, path: str) -> File: ...
     def shadow_file(self, path: str) -> ShadowFile: ...
+    def shadow_files(self, *paths: str) -> ShadowFiles: ...
     def shadow_dir(self, path: str) -> ShadowDir: ...
+    def batch(self) -> Batch: ...
     def mount_point(self, path: str) -> MountPoint: ...
     def package(self, package: str) -> Package: ...
     def user(self, user: str) -> User: ...
@@ -1,34 +1,65 @@
 import datetime
+import glob
 import json
+import os
 import re
-import time as time_lib
-from collections.abc import Iterator, Mapping
-from contextlib import contextmanager
+import subprocess
+import time
+import warnings
+from collections.abc import Generator, Iterator, Mapping
+from contextlib import ExitStack, contextmanager
 from typing import cast
 
 import pytest
+from _pytest.config import Config
+from _pytest.config.argparsing import Parser
 from _pytest.fixtures import FixtureRequest
+from _pytest.main import Session
 from _pytest.mark.structures import MarkDecorator
-from _pytest.python import Metafunc
+from _pytest.nodes import Item
+from _pytest.python import Function, Metafunc
+from _pytest.reports import TestReport
+from _pytest.terminal import TerminalReporter
 from helpers import (
+    TRACE,
+    Batch,
     CronRunner,
+    DurationHistory,
     Email,
     Journal,
+    Locks,
     MockServer,
     Net,
     OpenVPN,
     ShadowDir,
     ShadowFile,
+    ShadowFiles,
     Time,
+    Timer,
     Vagrant,
-    timer,
+    recover_shadows,
 )
+from schedule import order_tests, vm_state_changes
 from testinfra.host import Host
 from testinfra.modules.file import File
 from testinfra.utils import ansible_runner
 
 # ruff: noqa: DTZ011
 
+# Runs to take the median duration over
+_HISTORY_WINDOW = 10
+# Slowdowns smaller than this (seconds) are mostly noise, so never fail the session
+_MIN_SLOWDOWN = 5.0
+
+_SESSION_START = time.time()
+# Phase durations of each test this session, by node ID
+_DURATIONS: dict[str, dict[str, float]] = {}
+_PASSED: set[str] = set()
+# (test, seconds, median seconds) for each passing test with a history
+_DELTAS: list[tuple[str, float, float]] = []
+# VM state changes the collected tests need, 'before' and 'after' ordering them
+_SCHEDULE: dict[str, int] = {}
+
 _ANSIBLE_RUNNER = ansible_runner.AnsibleRunner(
     ".vagrant/provisioners/ansible/inventory/vagrant_ansible_inventory",
 )
@@ -100,6 +131,13 @@ def _host_shadow_file(self: Host, path: str) -> ShadowFile:
 Host.shadow_file = _host_shadow_file  # type: ignore[method-assign]
 
 
+def _host_shadow_files(self: Host, *paths: str) -> ShadowFiles:
+    return ShadowFiles(self, *paths)
+
+
+Host.shadow_files = _host_shadow_files  # type: ignore[method-assign]
+
+
 def _host_shadow_dir(self: Host, path: str) -> ShadowDir:
     return ShadowDir(self, path)
 
@@ -107,6 +145,13 @@ def _host_shadow_dir(self: Host, path: str) -> ShadowDir:
 Host.shadow_dir = _host_shadow_dir  # type: ignore[method-assign]
 
 
+def _host_batch(self: Host) -> Batch:
+    return Batch(self)
+
+
+Host.batch = _host_batch  # type: ignore[method-assign]
+
+
 def _host_client_ip(self: Host) -> str:
     return self.check_output('echo "${SSH_CLIENT}"').split()[0]
 
@@ -273,21 +318,72 @@ def masks() -> dict[str, str]:
 
 
 @pytest.fixture(scope="session")
-def vagrant() -> Vagrant:
-    return Vagrant()
+def vagrant(hosts: Mapping[str, Host]) -> Vagrant:
+    return Vagrant(hosts)
 
 
 def vms_down(*args: str) -> MarkDecorator:
     return pytest.mark.vms_down(vms=args)
 
 
+def pristine(*args: str) -> MarkDecorator:
+    """Restores VMs from their snapshots before each test; works on test classes too.
+
+    With no args, restores the test's host if it's parametrised by hostname, or else every VM.
+    """
+    return pytest.mark.pristine(vms=args)
+
+
+def uses_vms(*args: str) -> MarkDecorator:
+    """For tests parametrised by hostname that also change other VMs; see ensure_vm_state."""
+    return pytest.mark.uses_vms(vms=args)
+
+
+def runs_alone() -> MarkDecorator:
+    """For tests that change VM states themselves, so no other test can run at the same time."""
+    return pytest.mark.runs_alone()
+
+
+def pytest_addoption(parser: Parser) -> None:
+    parser.addoption(
+        "--save-snapshots",
+        action="store_true",
+        help="snapshot every VM at the start of the session, for tests marked 'pristine'; do this "
+        "right after provisioning",
+    )
+    parser.addoption(
+        "--trace-output",
+        default="trace.json",
+        help="where to write the session's timings, in Chrome's trace-event format",
+    )
+    parser.addoption(
+        "--durations-db",
+        default=".test-durations.sqlite",
+        help="SQLite database of each test's durations in every run",
+    )
+    parser.addoption(
+        "--max-slowdown",
+        type=float,
+        default=None,
+        help="fail if a passing test is slower than the median of its last "
+        f"{_HISTORY_WINDOW} passing runs by more than this fraction, e.g. 0.5",
+    )
+    parser.addoption(
+        "--keep-test-order",
+        action="store_true",
+        help="run tests in collection order, rather than ordering them to minimise VM state "
+        "changes",
+    )
+
+
 @pytest.fixture(scope="session")
 def net(
     hosts: Mapping[str, Host],
     addrs: Mapping[str, str],
+    masks: Mapping[str, str],
     vagrant: Vagrant,
 ) -> Net:
-    return Net(hosts, addrs, vagrant)
+    return Net(hosts, addrs, masks, vagrant)
 
 
 @pytest.fixture(scope="session")
@@ -316,21 +412,312 @@ def mockserver(
     return m
 
 
+@pytest.fixture(scope="session")
+def locks() -> Locks:
+    """Locks shared by every pytest-xdist worker."""
+    return Locks(".vagrant/test-locks")
+
+
+@pytest.fixture(scope="session", autouse=True)
+def recovered_shadows(
+    hosts: Mapping[str, Host],
+    vagrant: Vagrant,
+    locks: Locks,
+    testrun_uid: str,
+) -> None:
+    """Restores files and dirs left shadowed by an aborted run, so they don't leak into this one."""
+    # Only the first worker; the others would restore shadows that its tests are using
+    with locks.once("recovered-shadows", testrun_uid) as first:
+        if not first:
+            return
+        for vm in vagrant.running_vms():
+            restored = recover_shadows(hosts[vm])
+            if restored:
+                warnings.warn(f"Recovered shadows left on {vm}:\n{restored}", stacklevel=1)
+
+
+@pytest.fixture(scope="session", autouse=True)
+def saved_snapshots(
+    vagrant: Vagrant,
+    locks: Locks,
+    testrun_uid: str,
+    request: FixtureRequest,
+) -> None:
+    if not request.config.getoption("save_snapshots"):
+        return
+    with locks.once("saved-snapshots", testrun_uid) as first:
+        if not first:
+            return
+        with locks.vm_state(exclusive=True):
+            if locks.vm_state_changed():
+                vagrant.rescan_state()
+            vagrant.set_states()
+            vagrant.wait_ready(*vagrant.all_vms())
+            vagrant.save_snapshots()
+            locks.changed_vm_state()
+
+
+def _pristine_vms(vagrant: Vagrant, request: FixtureRequest) -> list[str]:
+    mark = request.node.get_closest_marker("pristine")
+    if mark is None:
+        return []
+    if mark.kwargs["vms"]:
+        return list(mark.kwargs["vms"])
+    if "hostname" in request.fixturenames:
+        return [request.getfixturevalue("hostname")]
+    return vagrant.all_vms()
+
+
+@contextmanager
+def _vm_state(
+    vagrant: Vagrant,
+    locks: Locks,
+    down: tuple[str, ...],
+    pristine: list[str],
+    exclusive: bool,
+) -> Iterator[None]:
+    """Holds the VM state lock, with the VMs in down down, the rest up, and pristine restored.
+
+    Restoring a VM reboots it under any test using it, e.g. to route through, so it's a state
+    change too. Once the lock is held exclusively, it's held until the test finishes, so no other
+    test touches a restored VM first.
+    """
+    up = [vm for vm in vagrant.all_vms() if vm not in down]
+    to_restore = list(pristine)
+    while True:
+        with locks.vm_state(exclusive):
+            if locks.vm_state_changed():
+                vagrant.rescan_state()
+            if exclusive:
+                restored = vagrant.restore_snapshots(*to_restore)
+                to_restore = []
+                if vagrant.set_states(down) or restored:
+                    # VMs that stayed up may have been busy reacting to the others changing state
+                    vagrant.wait_ready(*vagrant.running_vms())
+                    locks.changed_vm_state()
+            if not to_restore and vagrant.running_vms() == up:
+                yield
+                return
+        # Changing states has to wait for every other test to finish
+        exclusive = True
+
+
+def _test_locks(vagrant: Vagrant, request: FixtureRequest, pristine: list[str]) -> list[str]:
+    """Locks for the VMs and shared resources that the test uses."""
+    if "hostname" in request.fixturenames:
+        vms = [request.getfixturevalue("hostname"), *pristine]
+        mark = request.node.get_closest_marker("uses_vms")
+        if mark:
+            vms += mark.kwargs["vms"]
+    else:
+        vms = vagrant.all_vms()
+    # The internet VM's email and mock servers are cleared by every test that uses them
+    shared = [name for name in ("email", "mockserver") if name in request.fixturenames]
+    return [f"vm-{vm}" for vm in vms] + shared
+
+
 @pytest.fixture(scope="function", autouse=True)
-@timer
 def ensure_vm_state(
     vagrant: Vagrant,
+    locks: Locks,
     request: FixtureRequest,
-) -> None:
+) -> Iterator[None]:
+    """Holds locks for the test's VMs, so tests for other VMs can run at the same time.
+
+    Tests hold the VM state lock for as long as they run, so VM states only change between tests.
+    Tests parametrised by hostname lock that VM, and any others marked uses_vms; other tests lock
+    every VM. Tests marked runs_alone or pristine run while no other test does.
+    """
     down: tuple[str, ...] = ()
     for mark in request.keywords.get("pytestmark", []):
         if mark.name == "vms_down":
             down = mark.kwargs["vms"]
-    if vagrant.set_states(down):
-        time_lib.sleep(30)
+    # VMs that will be down don't need restoring
+    pristine = [vm for vm in _pristine_vms(vagrant, request) if vm not in down]
+    missing = [vm for vm in pristine if not vagrant.has_snapshot(vm)]
+    if missing:
+        pytest.fail(f"No snapshots of {missing}; run pytest with --save-snapshots")
+    alone = request.node.get_closest_marker("runs_alone") is not None
+    with ExitStack() as stack:
+        with Timer("ensure_vm_state"):
+            stack.enter_context(_vm_state(vagrant, locks, down, pristine, alone))
+            stack.enter_context(locks.hold(_test_locks(vagrant, request, pristine)))
+        yield
 
 
 def pytest_generate_tests(metafunc: Metafunc) -> None:
     marker = metafunc.definition.get_closest_marker("for_hosts")
     if marker:
         metafunc.parametrize("hostname", marker.kwargs["hosts"])
+
+
+@pytest.hookimpl(hookwrapper=True)
+def pytest_runtest_protocol(item: Item) -> Generator[None, object, None]:
+    TRACE.test = item.nodeid
+    with Timer(item.nodeid, category="test"):
+        yield
+    TRACE.test = None
+
+
+@pytest.hookimpl(hookwrapper=True)
+def pytest_runtest_setup(item: Item) -> Generator[None, object, None]:
+    with Timer(f"setup {item.nodeid}", category="phase"):
+        yield
+    # Goes in the setup report, which pytest-xdist sends from the worker that ran the test
+    item.user_properties.append(("vm_state", TRACE.total("ensure_vm_state", item.nodeid)))
+
+
+@pytest.hookimpl(hookwrapper=True)
+def pytest_runtest_call(item: Item) -> Generator[None, object, None]:
+    with Timer(f"call {item.nodeid}", category="phase"):
+        yield
+
+
+@pytest.hookimpl(hookwrapper=True)
+def pytest_runtest_teardown(item: Item) -> Generator[None, object, None]:
+    with Timer(f"teardown {item.nodeid}", category="phase"):
+        yield
+
+
+def _vms_down(item: Item) -> tuple[str, ...]:
+    mark = item.get_closest_marker("vms_down")
+    return tuple(sorted(mark.kwargs["vms"])) if mark else ()
+
+
+def _xdist_group(item: Item) -> str:
+    if isinstance(item, Function) and item.get_closest_marker("for_hosts"):
+        return str(item.callspec.params["hostname"])
+    return "all"
+
+
+# Before pytest-xdist appends each test's group to its ID
+@pytest.hookimpl(tryfirst=True)
+def pytest_collection_modifyitems(config: Config, items: list[Item]) -> None:
+    # With --dist loadgroup, pytest-xdist runs each group's tests on one worker, in order. Tests
+    # for different VMs can run at the same time; ensure_vm_state holds the locks to make that safe.
+    for item in items:
+        item.add_marker(pytest.mark.xdist_group(_xdist_group(item)))
+
+    # The testbed normally starts with every VM up
+    start: frozenset[str] = frozenset()
+    states = [frozenset(_vms_down(item)) for item in items]
+    _SCHEDULE["before"] = vm_state_changes(start, states)
+    if config.getoption("keep_test_order"):
+        _SCHEDULE["after"] = _SCHEDULE["before"]
+        return
+    # Runs each group of tests needing the same VMs down together, within each module and class.
+    # Under pytest-xdist this runs on each worker, and only orders that worker's share of tests.
+    order = order_tests(start, [(item.parent, frozenset(_vms_down(item))) for item in items])
+    items[:] = [items[i] for i in order]
+    _SCHEDULE["after"] = vm_state_changes(start, [frozenset(_vms_down(item)) for item in items])
+
+
+def pytest_report_collectionfinish() -> str | list[str]:
+    # The pytest-xdist controller doesn't collect, so has nothing to report
+    if not _SCHEDULE:
+        return []
+    before, after = _SCHEDULE["before"], _SCHEDULE["after"]
+    return f"VM state changes: {after} (collection order needs {before}, saves {before - after})"
+
+
+def pytest_runtest_logreport(report: TestReport) -> None:
+    # pytest-xdist appends the test's group to its ID
+    test = report.nodeid.partition("@")[0]
+    durations = _DURATIONS.setdefault(test, {})
+    durations[report.when] = report.duration
+    if report.when == "setup":
+        durations["vm_state"] = cast("float", dict(report.user_properties).get("vm_state", 0.0))
+    elif report.when == "call" and report.passed:
+        _PASSED.add(test)
+
+
+def _commit_id() -> str:
+    out = subprocess.run(
+        ["git", "describe", "--always", "--dirty"],
+        capture_output=True,
+        text=True,
+        check=False,
+    )
+    return out.stdout.strip() or "unknown"
+
+
+def _slowdown_exceeded(seconds: float, median: float, max_slowdown: float) -> bool:
+    return seconds - median > max(median * max_slowdown, _MIN_SLOWDOWN)
+
+
+def _worker_traces(trace_output: str) -> list[str]:
+    return sorted(glob.glob(glob.escape(trace_output) + ".gw*"))
+
+
+def pytest_sessionstart(session: Session) -> None:
+    if getattr(session.config, "workerinput", None) is None:
+        # Left by an aborted run
+        for path in _worker_traces(session.config.getoption("trace_output")):
+            os.remove(path)
+
+
+def pytest_sessionfinish(session: Session) -> None:
+    trace_output = session.config.getoption("trace_output")
+    workerinput = getattr(session.config, "workerinput", None)
+    if workerinput is not None:
+        # The controller merges this, and records durations from the reports workers send it
+        TRACE.write(f"{trace_output}.{workerinput['workerid']}")
+        return
+    for path in _worker_traces(trace_output):
+        TRACE.merge(path)
+        os.remove(path)
+    TRACE.write(trace_output)
+
+    if not _DURATIONS:
+        return
+    history = DurationHistory(session.config.getoption("durations_db"))
+    try:
+        medians = history.medians(_HISTORY_WINDOW)
+        history.add_run(_commit_id(), _SESSION_START, _DURATIONS, _PASSED)
+    finally:
+        history.close()
+    for test in sorted(_PASSED):
+        if test in medians:
+            d = _DURATIONS[test]
+            _DELTAS.append((test, d["setup"] + d["call"] + d.get("teardown", 0.0), medians[test]))
+
+    max_slowdown = session.config.getoption("max_slowdown")
+    if max_slowdown is not None and any(
+        _slowdown_exceeded(seconds, median, max_slowdown) for _, seconds, median in _DELTAS
+    ):
+        session.exitstatus = pytest.ExitCode.TESTS_FAILED
+
+
+def pytest_terminal_summary(terminalreporter: TerminalReporter) -> None:
+    slowest = TRACE.slowest(20, "helper")
+    if slowest:
+        terminalreporter.section("top 20 slowest operations")
+        for seconds, name, args in slowest:
+            line = f"{seconds:10.2f}s {name}({', '.join(args['args'])})"
+            if "test" in args:
+                line += f"  [{args['test']}]"
+            terminalreporter.write_line(line)
+        terminalreporter.write_line(
+            f"Full trace in {terminalreporter.config.getoption('trace_output')}",
+        )
+
+    if _DELTAS:
+        terminalreporter.section(f"largest changes from median of last {_HISTORY_WINDOW} runs")
+        for test, seconds, median in sorted(_DELTAS, key=lambda d: -abs(d[1] - d[2]))[:20]:
+            delta = seconds - median
+            percent = f"{delta / median:+.0%}" if median else "new"
+            terminalreporter.write_line(
+                f"{delta:+10.2f}s {percent:>6} {seconds:10.2f}s  {test}",
+            )
+
+    max_slowdown = terminalreporter.config.getoption("max_slowdown")
+    if max_slowdown is not None:
+        slow = [
+            test
+            for test, seconds, median in _DELTAS
+            if _slowdown_exceeded(seconds, median, max_slowdown)
+        ]
+        if slow:
+            terminalreporter.section(f"slower than median by more than {max_slowdown:.0%}")
+            for test in slow:
+                terminalreporter.write_line(test)
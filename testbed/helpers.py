@@ -1,18 +1,26 @@
+import base64
 import datetime
+import fcntl
 import inspect
 import ipaddress
 import json
 import logging
 import os.path
 import re
+import shlex
+import sqlite3
+import statistics
+import subprocess
+import threading
 import time as time_lib
+import xml.etree.ElementTree as ET
 from collections import OrderedDict
-from collections.abc import Callable, Iterator, Mapping, Sequence, Set
+from collections.abc import Callable, Iterable, Iterator, Mapping, Sequence, Set
 from concurrent.futures import ThreadPoolExecutor
-from contextlib import contextmanager
+from contextlib import ExitStack, contextmanager
 from functools import wraps
 from typing import Any, TypeVar, cast
-from urllib.parse import ParseResult, urlparse
+from urllib.parse import ParseResult, quote, urlparse
 
 import codetiming
 import pytest
@@ -29,11 +37,145 @@ from tidylib import tidy_document
 
 T = TypeVar("T")
 
+# Every hop is a VM on a local network, so replies come back well within this (seconds)
+_TRACEROUTE_WAIT = 1
+# Defines 'trace TARGET (all | only IP...)', which prints traceroute's output, stopping after the
+# first hop that isn't one of the given IPs. Stopping closes the pipe, which ends traceroute.
+_TRACE_FUNCTION = """
+set -u
+d="$(mktemp -d)"
+trace() {{
+    local target="$1" mode="$2"
+    shift 2
+    traceroute -I -n -q 1 -m {max_hops} -w {wait} "${{target}}" 2>&1 | while IFS= read -r line; do
+        echo "${{line}}"
+        read -r hop ip _ <<<"${{line}}"
+        if [ "${{mode}}" = only ] && [[ "${{hop}}" =~ ^[0-9]+$ ]] &&
+            [[ " $* " != *" ${{ip}} "* ]]; then
+            break
+        fi
+    done
+}}
+"""
+
+
+class Trace:
+    """Timings in Chrome's trace-event format, for chrome://tracing or https://ui.perfetto.dev.
+
+    Each timing is a complete event on the thread that made it; viewers nest events on a thread by
+    time. Events are tagged with the test that was running, if any. Events last the whole session,
+    so long args, such as a helper's full output, are cut short.
+    """
+
+    MAX_ARG_LENGTH = 200
+
+    def __init__(self) -> None:
+        super().__init__()
+        self._lock = threading.Lock()
+        self._origin = time_lib.perf_counter()
+        self._events: list[dict[str, Any]] = []
+        self._threads: set[int] = set()
+        self.test: str | None = None
+
+    def add(
+        self,
+        name: str,
+        category: str,
+        start: float,
+        duration: float,
+        args: Mapping[str, object],
+    ) -> None:
+        """Adds an event; start is from time.perf_counter, and duration is in seconds."""
+        thread = threading.current_thread()
+        tid = thread.native_id or 0
+        event_args = {k: self._short(v) for k, v in args.items()}
+        if self.test is not None:
+            event_args["test"] = self.test
+        with self._lock:
+            if tid not in self._threads:
+                self._threads.add(tid)
+                self._events.append(
+                    {
+                        "name": "thread_name",
+                        "ph": "M",
+                        "pid": os.getpid(),
+                        "tid": tid,
+                        "args": {"name": thread.name},
+                    },
+                )
+            self._events.append(
+                {
+                    "name": name,
+                    "cat": category,
+                    "ph": "X",
+                    "ts": (start - self._origin) * 1e6,
+                    "dur": duration * 1e6,
+                    "pid": os.getpid(),
+                    "tid": tid,
+                    "args": event_args,
+                },
+            )
+
+    @classmethod
+    def _short(cls, value: object) -> object:
+        if isinstance(value, str) and len(value) > cls.MAX_ARG_LENGTH:
+            return value[: cls.MAX_ARG_LENGTH] + f"... ({len(value)} chars)"
+        if isinstance(value, list):
+            return [cls._short(v) for v in value]
+        return value
+
+    def slowest(self, n: int, category: str) -> list[tuple[float, str, dict[str, Any]]]:
+        """(seconds, name, args) of the n longest events in category, longest first."""
+        with self._lock:
+            events = [e for e in self._events if e.get("cat") == category]
+        events.sort(key=lambda e: e["dur"], reverse=True)
+        return [(e["dur"] / 1e6, e["name"], e["args"]) for e in events[:n]]
+
+    def total(self, name: str, test: str) -> float:
+        """Seconds spent in events called name during test."""
+        with self._lock:
+            durations = [
+                float(e["dur"])
+                for e in self._events
+                if e["name"] == name and e["args"].get("test") == test
+            ]
+        return sum(durations) / 1e6
+
+    def write(self, path: str) -> None:
+        with self._lock, open(path, "w", encoding="utf-8") as f:
+            json.dump(
+                {
+                    "traceEvents": self._events,
+                    "displayTimeUnit": "ms",
+                    "otherData": {"origin": self._origin},
+                },
+                f,
+            )
+
+    def merge(self, path: str) -> None:
+        """Adds the events in a trace written by another process on this machine."""
+        with open(path, encoding="utf-8") as f:
+            trace = json.load(f)
+        # perf_counter is the same clock in every process, so only the origins differ
+        offset = (trace["otherData"]["origin"] - self._origin) * 1e6
+        with self._lock:
+            for event in trace["traceEvents"]:
+                if "ts" in event:
+                    event["ts"] += offset
+                self._events.append(event)
+
+
+# Every Timer adds to this
+TRACE = Trace()
+
 
 class Timer(codetiming.Timer):
-    def __init__(self, name: str = "[unnamed timer]") -> None:
+    def __init__(self, name: str = "[unnamed timer]", category: str = "helper") -> None:
         super().__init__(name=name, logger=logging.debug)
+        self._category = category
+        self._start = 0.0
         self._args: list[str] = []
+        self._raw_args: list[str] = []
         self._retval: object = None
         self._extra_text: list[object] = []
 
@@ -59,7 +201,8 @@ class Timer(codetiming.Timer):
         self.text = first_line + msg
 
     def set_args(self, *args: Any) -> None:
-        self._args = [Timer._escape_str(str(arg)) for arg in args]
+        self._raw_args = [str(arg) for arg in args]
+        self._args = [Timer._escape_str(arg) for arg in self._raw_args]
 
     def set_retval(self, retval: object) -> None:
         self._retval = retval
@@ -68,11 +211,18 @@ class Timer(codetiming.Timer):
         self._extra_text.append(extra)
 
     def __enter__(self) -> "Timer":
+        self._start = time_lib.perf_counter()
         return super().__enter__()
 
     def __exit__(self, *exc_info: object) -> None:
         self._update_text()
         super().__exit__(*exc_info)
+        args: dict[str, object] = {"args": self._raw_args}
+        if self._retval is not None:
+            args["result"] = str(self._retval)
+        if self._extra_text:
+            args["extra"] = [str(item) for item in self._extra_text]
+        TRACE.add(str(self.name), self._category, self._start, self.last, args)
 
     def __call__(self, *args: Any) -> Any:
         raise NotImplementedError("Do not use 'Timer' as a decorator, use 'timer' instead")
@@ -101,14 +251,320 @@ def timer(f: Callable[..., T]) -> Callable[..., T]:
     return inner
 
 
+class DurationHistory:
+    """Each test's durations in every recorded run, in an SQLite database.
+
+    Durations are in seconds; 'setup' includes 'vm_state', the time spent getting the VMs into
+    the state the test needs.
+    """
+
+    PHASES = ("setup", "vm_state", "call", "teardown")
+
+    def __init__(self, path: str) -> None:
+        super().__init__()
+        self._db = sqlite3.connect(path)
+        with self._db:
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS runs ("
+                "id INTEGER PRIMARY KEY, commit_id TEXT NOT NULL, started REAL NOT NULL)",
+            )
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS durations ("
+                "run INTEGER NOT NULL REFERENCES runs(id), test TEXT NOT NULL, "
+                "passed INTEGER NOT NULL, setup REAL NOT NULL, vm_state REAL NOT NULL, "
+                "call REAL NOT NULL, teardown REAL NOT NULL, PRIMARY KEY (run, test))",
+            )
+
+    def add_run(
+        self,
+        commit_id: str,
+        started: float,
+        durations: Mapping[str, Mapping[str, float]],
+        passed: Set[str],
+    ) -> None:
+        with self._db:
+            run = self._db.execute(
+                "INSERT INTO runs (commit_id, started) VALUES (?, ?)",
+                (commit_id, started),
+            ).lastrowid
+            self._db.executemany(
+                "INSERT INTO durations VALUES (?, ?, ?, ?, ?, ?, ?)",
+                [
+                    (run, test, test in passed, *(d.get(phase, 0.0) for phase in self.PHASES))
+                    for test, d in durations.items()
+                ],
+            )
+
+    def medians(self, window: int) -> dict[str, float]:
+        """Median total duration of each test over its last window passing runs."""
+        totals: dict[str, list[float]] = {}
+        for test, total in self._db.execute(
+            "SELECT test, setup + call + teardown FROM durations WHERE passed ORDER BY run DESC",
+        ):
+            if len(totals.setdefault(test, [])) < window:
+                totals[test].append(total)
+        return {test: statistics.median(t) for test, t in totals.items()}
+
+    def close(self) -> None:
+        self._db.close()
+
+
+class Locks:
+    """File locks shared by every process running tests at once, e.g. pytest-xdist workers.
+
+    Tests hold the VM state lock shared while they run, and VM states only change while it's held
+    exclusively, i.e. while no test runs. Other locks are exclusive, and must be taken after the
+    VM state lock, all at once, so holders never wait on each other in a cycle.
+    """
+
+    def __init__(self, path: str) -> None:
+        super().__init__()
+        self._path = path
+        os.makedirs(path, exist_ok=True)
+        self._generation = self._read("vm-state.generation")
+
+    @contextmanager
+    def _flock(self, name: str, exclusive: bool = True) -> Iterator[None]:
+        # Closing the file releases the lock
+        with open(os.path.join(self._path, f"{name}.lock"), "a", encoding="utf-8") as f:
+            fcntl.flock(f, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+            yield
+
+    def _read(self, name: str) -> str:
+        try:
+            with open(os.path.join(self._path, name), encoding="utf-8") as f:
+                return f.read()
+        except FileNotFoundError:
+            return ""
+
+    def _write(self, name: str, content: str) -> None:
+        with open(os.path.join(self._path, name), "w", encoding="utf-8") as f:
+            f.write(content)
+
+    @contextmanager
+    def vm_state(self, exclusive: bool) -> Iterator[None]:
+        # Exclusive holders wait at the gate, which stops new shared holders starving them
+        with ExitStack() as stack:
+            with self._flock("gate"):
+                stack.enter_context(self._flock("vm-state", exclusive))
+            yield
+
+    def vm_state_changed(self) -> bool:
+        """Whether another process changed VM states since this one last looked or changed them.
+
+        Call while holding the VM state lock.
+        """
+        generation = self._read("vm-state.generation")
+        changed = generation != self._generation
+        self._generation = generation
+        return changed
+
+    def changed_vm_state(self) -> None:
+        """Tells other processes that VM states changed. Call while holding it exclusively."""
+        self._generation = str(int(self._generation or "0") + 1)
+        self._write("vm-state.generation", self._generation)
+
+    @contextmanager
+    def hold(self, names: Iterable[str]) -> Iterator[None]:
+        with ExitStack() as stack:
+            for name in sorted(set(names)):
+                stack.enter_context(self._flock(name))
+            yield
+
+    @contextmanager
+    def once(self, name: str, run_id: str) -> Iterator[bool]:
+        """Yields whether this process is the run's first here; the rest wait until it's done."""
+        with self._flock(f"once-{name}"):
+            first = self._read(f"once-{name}") != run_id
+            yield first
+            if first:
+                self._write(f"once-{name}", run_id)
+
+
+class Condition:
+    """Something to wait for: a check, what it means, and what to report if it never holds.
+
+    Checks that raise count as not holding yet; the last error is part of the diagnostic.
+    """
+
+    def __init__(
+        self,
+        description: str,
+        check: Callable[[], bool],
+        diagnose: Callable[[], object] | None = None,
+    ) -> None:
+        super().__init__()
+        self._description = description
+        self._check = check
+        self._diagnose = diagnose
+        self._error: Exception | None = None
+
+    def __call__(self) -> bool:
+        try:
+            return self._check()
+        except Exception as e:  # noqa: BLE001
+            self._error = e
+            return False
+
+    def __str__(self) -> str:
+        return self._description
+
+    def diagnose(self) -> str:
+        lines = []
+        if self._error is not None:
+            lines.append(f"Last error: {self._error}")
+        if self._diagnose is not None:
+            try:
+                lines.append(str(self._diagnose()))
+            except Exception as e:  # noqa: BLE001
+                lines.append(f"Diagnostic failed: {e}")
+        return "\n".join(lines)
+
+
+def poll_until(
+    predicate: Callable[[], bool],
+    timeout: float,
+    backoff: float = 1.5,
+    interval: float = 1,
+    max_interval: float = 15,
+) -> bool:
+    """Checks predicate until it's true or timeout seconds pass; returns whether it became true.
+
+    The wait between checks starts at interval and is multiplied by backoff after each check, up
+    to max_interval.
+    """
+    deadline = time_lib.monotonic() + timeout
+    while True:
+        if predicate():
+            return True
+        remaining = deadline - time_lib.monotonic()
+        if remaining <= 0:
+            return False
+        time_lib.sleep(min(interval, remaining))
+        interval = min(interval * backoff, max_interval)
+
+
+@timer
+def wait_until(
+    predicate: Callable[[], bool],
+    timeout: float,
+    backoff: float = 1.5,
+    interval: float = 1,
+    max_interval: float = 15,
+) -> None:
+    """Like poll_until, but fails the test if predicate isn't true in time."""
+    if not poll_until(predicate, timeout, backoff, interval, max_interval):
+        msg = f"Timed out after {timeout} s waiting for {predicate}"
+        if isinstance(predicate, Condition):
+            msg += "\n" + predicate.diagnose()
+        pytest.fail(msg)
+
+
+def ssh_answering(host: Host) -> Condition:
+    return Condition("SSH to answer", lambda: host.run("true").rc == 0)
+
+
+def unit_active(host: Host, unit: str, active: bool = True) -> Condition:
+    def diagnose() -> str:
+        return host.run(f"systemctl status --no-pager '{unit}'").stdout
+
+    return Condition(
+        f"unit '{unit}' to be {'active' if active else 'inactive'}",
+        lambda: host.service(unit).is_running == active,
+        diagnose,
+    )
+
+
+def process_running(host: Host, cmdline: str, running: bool = True) -> Condition:
+    """Whether a process with exactly this command line is running."""
+    return Condition(
+        f"process '{cmdline}' to {'appear' if running else 'exit'}",
+        lambda: (host.run(f"pgrep -x -f '{cmdline}'").rc == 0) == running,
+        lambda: host.check_output("ps -eo pid,args"),
+    )
+
+
+def cron_idle(host: Host) -> Condition:
+    """Whether cron has no jobs running, including the children that mail a job's output."""
+
+    def idle() -> bool:
+        pid = host.check_output("systemctl show --property MainPID --value cron")
+        return host.run(f"pgrep -P '{pid}'").rc != 0
+
+    return Condition(
+        "cron to finish its jobs",
+        idle,
+        lambda: host.check_output("ps -eo pid,ppid,args"),
+    )
+
+
+def tun_up(host: Host, count: int = 1) -> Condition:
+    """Whether at least count tun interfaces are up."""
+
+    def up() -> int:
+        return len(Lines(host.check_output("ip -o link show up type tun")))
+
+    return Condition(
+        f"{count} tun interface(s) to be up",
+        lambda: up() >= count,
+        lambda: host.check_output("ip -o link show type tun"),
+    )
+
+
+# Queried from inside the container, so this doesn't depend on how traefik exposes it
+_PROMETHEUS_API = (
+    "docker exec monitoring-prometheus-1 wget -qO- 'http://localhost:8080/prometheus/api/v1/{}'"
+)
+
+
+def _prometheus(host: Host, path: str) -> Any:
+    with host.sudo():
+        return json.loads(host.check_output(_PROMETHEUS_API.format(path)))["data"]
+
+
+def prometheus_alert_firing(host: Host, alert: str) -> Condition:
+    def firing() -> bool:
+        return any(
+            a["labels"]["alertname"] == alert and a["state"] == "firing"
+            for a in _prometheus(host, "alerts")["alerts"]
+        )
+
+    return Condition(
+        f"prometheus alert '{alert}' to fire",
+        firing,
+        lambda: json.dumps(_prometheus(host, "alerts"), sort_keys=True, indent=2),
+    )
+
+
+def prometheus_value(host: Host, query: str, value: float) -> Condition:
+    """Whether every series the query returns has the value."""
+
+    def result() -> list[Any]:
+        return cast("list[Any]", _prometheus(host, "query?query=" + quote(query))["result"])
+
+    return Condition(
+        f"'{query}' to be {value}",
+        lambda: bool(result()) and all(float(r["value"][1]) == value for r in result()),
+        lambda: json.dumps(result(), sort_keys=True, indent=2),
+    )
+
+
 class Vagrant:
+    # How long a VM may take to be ready after booting
+    _READY_TIMEOUT = 300
+    # Snapshot of each VM in a known-good state, which tests can ask to be restored to
+    SNAPSHOT = "pi-server-testbed-pristine"
+
     @timer
-    def __init__(self) -> None:
+    def __init__(self, hosts: Mapping[str, Host]) -> None:
         super().__init__()
         self._v = vagrant_lib.Vagrant()
+        self._hosts = hosts
         # VM operations are slow, so we cache the state. If state is modified externally, run
         # rescan_state to update the cache.
         self._state: dict[str, bool] = {}
+        self._transitions: list[tuple[str, str, float]] = []
+        self._snapshots: dict[str, bool] = {}
         self.rescan_state()
 
     def rescan_state(self) -> None:
@@ -123,24 +579,48 @@ class Vagrant:
     def running_vms(self) -> list[str]:
         return sorted([vm for vm, up in self._state.items() if up])
 
-    @timer
+    def transitions(self) -> list[tuple[str, str, float]]:
+        """(vm, transition, seconds) for each state change so far, in the order they finished."""
+        return list(self._transitions)
+
+    def _transition(self, vm: str, name: str, f: Callable[[], None]) -> None:
+        with Timer(f"Vagrant.{name}") as t:
+            t.set_args(vm)
+            f()
+        self._transitions.append((vm, name, t.last))
+
     def up(self, vm: str) -> None:
         if not self._state[vm]:
-            self._v.up(vm_name=vm)
-            self._state[vm] = True
 
-    @timer
+            def up() -> None:
+                self._v.up(vm_name=vm)
+                self._state[vm] = True
+                self._wait_ready(vm)
+
+            self._transition(vm, "up", up)
+
     def down(self, vm: str) -> None:
         if self._state[vm]:
-            self._v.halt(vm_name=vm)
-            self._state[vm] = False
+
+            def down() -> None:
+                self._v.halt(vm_name=vm)
+                self._state[vm] = False
+
+            self._transition(vm, "down", down)
+
+    @staticmethod
+    def _parallel(f: Callable[[str], None], vms: Sequence[str]) -> None:
+        # VMs don't depend on each other to boot, so each can change state in its own thread
+        with ThreadPoolExecutor(max(len(vms), 1)) as e:
+            list(e.map(f, vms))
 
     @timer
     def reboot(self, *vms: str) -> None:
-        for vm in vms:
+        def reboot(vm: str) -> None:
             self.down(vm)
             self.up(vm)
-        time_lib.sleep(60)
+
+        self._parallel(reboot, vms)
 
     def set_state(self, vm: str, state: bool) -> None:
         if state:
@@ -148,12 +628,95 @@ class Vagrant:
         else:
             self.down(vm)
 
+    @timer
     def set_states(self, vms_down: Sequence[str] = ()) -> bool:
         old_state = self.running_vms()
-        for vm in self.all_vms():
-            self.set_state(vm, vm not in vms_down)
+        self._parallel(lambda vm: self.set_state(vm, vm not in vms_down), self.all_vms())
         return self.running_vms() != old_state
 
+    @staticmethod
+    def _vagrant(*args: str) -> str:
+        # python-vagrant's snapshot methods can't pick a VM
+        return subprocess.run(
+            ["vagrant", *args],
+            check=True,
+            capture_output=True,
+            text=True,
+        ).stdout
+
+    def has_snapshot(self, vm: str) -> bool:
+        if vm not in self._snapshots:
+            self._snapshots[vm] = self.SNAPSHOT in self._vagrant("snapshot", "list", vm).split()
+        return self._snapshots[vm]
+
+    @timer
+    def save_snapshots(self) -> None:
+        """Snapshots every VM, replacing any existing snapshots. All VMs must be running."""
+        if self.running_vms() != self.all_vms():
+            raise ValueError("All VMs must be running to snapshot them")
+
+        def save(vm: str) -> None:
+            def f() -> None:
+                self._vagrant("snapshot", "save", "--force", vm, self.SNAPSHOT)
+                self._snapshots[vm] = True
+
+            self._transition(vm, "snapshot", f)
+
+        self._parallel(save, self.all_vms())
+
+    @timer
+    def restore_snapshots(self, *vms: str) -> bool:
+        """Restores VMs to their snapshots, leaving them running; takes seconds per VM.
+
+        Returns whether any VM was restored. Like a VM going up or down, that's a state change that
+        other VMs may be busy reacting to.
+        """
+
+        def restore(vm: str) -> None:
+            def f() -> None:
+                self._vagrant("snapshot", "restore", "--no-provision", vm, self.SNAPSHOT)
+                self._state[vm] = True
+                host = self._hosts[vm]
+                wait_until(ssh_answering(host), self._READY_TIMEOUT)
+                # The VM resumes with its clock as it was when the snapshot was taken
+                host.check_output(f"sudo date -u -s @{time_lib.time():.3f}")
+
+            self._transition(vm, "restore", f)
+
+        self._parallel(restore, vms)
+        return bool(vms)
+
+    @timer
+    def wait_ready(self, *vms: str) -> None:
+        """Waits until each VM answers SSH, has finished booting, and its containers are healthy."""
+        self._parallel(self._wait_ready, vms)
+
+    def _wait_ready(self, vm: str) -> None:
+        with Timer("Vagrant.wait_ready") as t:
+            t.set_args(vm)
+            host = self._hosts[vm]
+            deadline = time_lib.monotonic() + self._READY_TIMEOUT
+
+            def remaining() -> int:
+                return max(int(deadline - time_lib.monotonic()), 1)
+
+            wait_until(ssh_answering(host), remaining())
+
+            # 'degraded' means booting finished but a unit failed; tests check that themselves
+            state = host.run(f"timeout {remaining()} systemctl is-system-running --wait").stdout
+            if state.strip() not in ("running", "degraded"):
+                pytest.fail(f"{vm} didn't finish booting: systemd state is '{state.strip()}'")
+
+            containers = host.run(
+                f"timeout {remaining()} bash -c "
+                "'if command -v docker >/dev/null; then "
+                "while sudo docker ps -q --filter health=starting | grep -q .; do sleep 1; done; "
+                "fi'",
+            )
+            if containers.rc != 0:
+                starting = host.run("sudo docker ps --filter health=starting --format '{{.Names}}'")
+                pytest.fail(f"{vm} has containers still starting: {starting.stdout.split()}")
+
 
 class AddrInNet:
     def __init__(self, mask: str) -> None:
@@ -176,23 +739,32 @@ class Net:
         self,
         hosts: Mapping[str, Host],
         addrs: Mapping[str, str],
+        masks: Mapping[str, str],
         vagrant: Vagrant,
     ) -> None:
         super().__init__()
         self._hosts = hosts
         self._addrs = addrs
         self._vagrant = vagrant
+        # A path through the testbed enters each network at most once, plus one hop to leave it
+        self._max_hops = len(masks) + 1
 
     @timer
-    def reachable(self, host: str, addr: str) -> bool:
-        return self._hosts[host].addr(self._addrs[addr]).is_reachable
-
-    @timer
-    def traceroute(self, t: Timer, host: str, addr: str) -> list[str]:
-        """Gets the hops from host to addr; empty list means unreachable."""
-        result = trparse.loads(
-            self._hosts[host].check_output("sudo traceroute -I %s", self._addrs[addr]),
-        )
+    def reachable(self, t: Timer, host: str, addrs: Sequence[str]) -> dict[str, bool]:
+        """Whether each addr answers ping from host; all addrs are pinged at once."""
+        targets = sorted({self._addrs[addr] for addr in addrs})
+        # One try with a 1 s timeout, as testinfra's is_reachable did
+        result = self._hosts[host].run("fping -a -r 0 -t 1000 " + " ".join(targets))
+        # 1 means some were unreachable, 2 that some names couldn't be resolved
+        if result.rc > 2:  # noqa: PLR2004
+            raise ValueError(f"fping on {host} failed: {result.stderr}")
+        alive = set(result.stdout.split())
+        t.add_extra(result.stdout)
+        return {addr: self._addrs[addr] in alive for addr in addrs}
+
+    def _parse_traceroute(self, t: Timer, host: str, addr: str, output: str) -> list[str]:
+        result = trparse.loads(output)
+        t.add_extra(result)
         for hop in result.hops:
             for probe in hop.probes:
                 if probe.annotation:
@@ -212,42 +784,81 @@ class Net:
                 out.append("")
 
         # A failure is a failure, regardless of where it tried to go in the meantime
-        if addr != "external" and out[-1] != self._addrs[addr]:
+        if not out or (addr != "external" and out[-1] != self._addrs[addr]):
             return []
-
-        t.add_extra(result)
         return out
 
+    @timer
+    def traceroute(
+        self,
+        t: Timer,
+        host: str,
+        paths: Mapping[str, Sequence[str] | None],
+    ) -> dict[str, list[str]]:
+        """Gets the hops from host to each addr; empty list means unreachable.
+
+        All addrs are traced at once, by one command on host. paths gives the IPs each trace may
+        pass through; it stops at the first hop that isn't one of them, as the result can only
+        be a failure from then on. None means any hop is allowed.
+        """
+        lines = [_TRACE_FUNCTION.format(max_hops=self._max_hops, wait=_TRACEROUTE_WAIT)]
+        addrs = sorted(paths)
+        for i, addr in enumerate(addrs):
+            allowed = paths[addr]
+            args = ["all"] if allowed is None else ["only", *allowed]
+            lines.append(
+                f'trace {shlex.join([self._addrs[addr], *args])} > "${{d}}/{i}" &',
+            )
+        lines.append("wait")
+        lines.extend(f'echo "### {i}"; cat "${{d}}/{i}"' for i in range(len(addrs)))
+        lines.append('rm -r "${d}"')
+
+        output = self._hosts[host].check_output("sudo bash -c %s", "\n".join(lines))
+        outputs = re.split(r"^### \d+$\n?", output, flags=re.MULTILINE)[1:]
+        return {
+            addr: self._parse_traceroute(t, host, addr, text)
+            for addr, text in zip(addrs, outputs, strict=True)
+        }
+
     @timer
     def nmap(
         self,
         t: Timer,
         host: str,
-        addr: str,
+        addrs: Sequence[str],
         ranges: Sequence[tuple[int, int]],
-    ) -> dict[str, set[int]]:
-        """Gets the open ports on addr as seen from host."""
+    ) -> dict[str, dict[str, set[int]]]:
+        """Gets the open ports on each addr as seen from host, with one scan of all of them."""
         ports = ",".join([f"{a}-{b}" for (a, b) in ranges])
+        targets = sorted({self._addrs[addr] for addr in addrs})
+        # UDP ports that don't answer are open|filtered, which counts as open
         result = self._hosts[host].check_output(
-            f"sudo nmap -p{ports} --open -Pn -oN - -T4 -sU -sS " + self._addrs[addr],
+            f"sudo nmap -p{ports} --open -Pn -oX - -T4 -sU -sS --max-retries 1 "
+            "--host-timeout 10m " + " ".join(targets),
         )
-        udp = set()
-        tcp = set()
-        for line in result.split("\n"):
-            match = re.match("^([0-9]+)/(tcp|udp) +([^ ]+)", line)
-            if match is not None:
-                port = int(match.group(1))
-                protocol = match.group(2)
-                state = match.group(3).split("|")
-                if "open" in state:
-                    if protocol == "udp":
-                        udp.add(port)
-                    elif protocol == "tcp":
-                        tcp.add(port)
-                    else:
-                        raise ValueError(f"nmap returned an unknown protocol '{protocol}'")
         t.add_extra(result)
-        return {"tcp": tcp, "udp": udp}
+
+        found: dict[str, dict[str, set[int]]] = {}
+        for h in ET.fromstring(result).iter("host"):
+            if h.get("timedout") == "true":
+                raise ValueError(f"nmap from {host} timed out scanning {h.find('address')}")
+            open_ports: dict[str, set[int]] = {"tcp": set(), "udp": set()}
+            for port in h.iter("port"):
+                protocol = port.get("protocol", "")
+                state = port.find("state")
+                if state is not None and "open" in state.get("state", "").split("|"):
+                    if protocol not in open_ports:
+                        raise ValueError(f"nmap returned an unknown protocol '{protocol}'")
+                    open_ports[protocol].add(int(port.get("portid", "")))
+            names = [a.get("addr") for a in h.iter("address")]
+            names.extend(n.get("name") for n in h.iter("hostname") if n.get("type") == "user")
+            for name in names:
+                if name:
+                    found[name] = open_ports
+
+        # With --open, nmap may leave out targets with no open ports
+        none_open: dict[str, set[int]] = {"tcp": set(), "udp": set()}
+        return {addr: found.get(self._addrs[addr], none_open) for addr in addrs}
 
     def _host_addr_pairs(self, hosts: Sequence[str]) -> list[tuple[str, str]]:
         running_vms = self._vagrant.running_vms()
@@ -263,6 +874,20 @@ class Net:
             out.extend((host, addr) for addr in sorted(self._addrs))
         return out
 
+    def _per_host(
+        self,
+        f: Callable[[str, Sequence[str]], Mapping[str, T]],
+        host_addr_pairs: Sequence[tuple[str, str]],
+    ) -> dict[tuple[str, str], T]:
+        """Runs f once per host, for all of that host's addrs, with the hosts in parallel."""
+        addrs: dict[str, list[str]] = {}
+        for host, addr in host_addr_pairs:
+            addrs.setdefault(host, []).append(addr)
+        logging.debug("Running %d probes", len(addrs))  # noqa: LOG015
+        with ThreadPoolExecutor(max(len(addrs), 1)) as e:
+            results = dict(zip(addrs, e.map(f, addrs, addrs.values()), strict=True))
+        return {(host, addr): results[host][addr] for host, addr in host_addr_pairs}
+
     def _assert_result(
         self,
         want_fn: Callable[[str, str], object],
@@ -296,10 +921,16 @@ class Net:
             from that host. All host/addr pairs not listed will be checked for
             being unreachable.
         """
+        host_addr_pairs = self._host_addr_pairs(sorted(reachable))
+        results = self._per_host(self.reachable, host_addr_pairs)
+
+        def reachable_from(host: str, addr: str) -> bool:
+            return results[(host, addr)]
+
         self._assert_result(
             lambda host, addr: addr in reachable[host],
-            self.reachable,
-            self._host_addr_pairs(sorted(reachable)),
+            reachable_from,
+            host_addr_pairs,
         )
 
     @timer
@@ -312,8 +943,32 @@ class Net:
           not listed will be checked for being unreachable.
         """
 
+        testbed_ips = sorted(ip for name, ip in self._addrs.items() if name != "external")
+
+        def want(host: str, addr: str) -> list[object]:
+            return [
+                (self._addrs[hop] if isinstance(hop, str) else hop)
+                for hop in ([*routes[host][addr], addr] if addr in routes[host] else [])
+            ]
+
+        def path(host: str, addr: str) -> list[str] | None:
+            if addr == "external":
+                # Once packets leave the testbed we don't care where they go
+                return testbed_ips
+            hops = want(host, addr)
+            if all(isinstance(hop, str) for hop in hops):
+                return cast("list[str]", hops)
+            # Can't check hops like AddrInNet on the host, so trace the whole way
+            return None
+
+        host_addr_pairs = self._host_addr_pairs(sorted(routes))
+        results = self._per_host(
+            lambda host, addrs: self.traceroute(host, {addr: path(host, addr) for addr in addrs}),
+            host_addr_pairs,
+        )
+
         def traceroute(host: str, addr: str) -> list[str]:
-            result = self.traceroute(host, addr)
+            result = results[(host, addr)]
             if addr == "external" and result:
                 # External is a special case, in that we don't care where the packets go once they
                 # leave the testbed.
@@ -325,14 +980,7 @@ class Net:
                 result = [*new_result, self._addrs[addr]]
             return result
 
-        self._assert_result(
-            lambda host, addr: [
-                (self._addrs[hop] if isinstance(hop, str) else hop)
-                for hop in ([*routes[host][addr], addr] if addr in routes[host] else [])
-            ],
-            traceroute,
-            self._host_addr_pairs(sorted(routes)),
-        )
+        self._assert_result(want, traceroute, host_addr_pairs)
 
     @timer
     def assert_ports_open(
@@ -344,9 +992,17 @@ class Net:
         host_addr_pairs: list[tuple[str, str]] = []
         for host in ports:
             host_addr_pairs.extend((host, addr) for addr in ports[host])
+        results = self._per_host(
+            lambda host, addrs: self.nmap(host, addrs, ranges),
+            host_addr_pairs,
+        )
+
+        def nmap(host: str, addr: str) -> dict[str, set[int]]:
+            return results[(host, addr)]
+
         self._assert_result(
             lambda host, addr: ports[host][addr],
-            lambda host, addr: self.nmap(host, addr, ranges),
+            nmap,
             host_addr_pairs,
         )
 
@@ -359,12 +1015,34 @@ class Email:
         self._host = host
 
     def clear(self) -> None:
-        # SSH login emails are sent asynchronously so they don't delay login. So we
-        # sleep to allow login emails from previous tests to arrive before clearing.
-        time_lib.sleep(5)
+        # SSH login emails are sent asynchronously so they don't delay login. So we wait for
+        # login emails from previous tests to stop arriving before clearing.
+        self._wait_quiet(5)
         r = requests.delete(f"http://{self._host}:{self._PORT}/api/emails", timeout=60)
         r.raise_for_status()
 
+    def received(self, count: int, only_from: str | None = None) -> Condition:
+        """Whether at least count emails have arrived."""
+        return Condition(
+            f"{count} email(s)",
+            lambda: len(self._get(only_from)) >= count,
+            lambda: json.dumps(self._get(only_from), sort_keys=True, indent=2),
+        )
+
+    def _wait_quiet(self, quiet: float, only_from: str | None = None) -> None:
+        """Waits until no email has arrived for quiet seconds, or for at most 4 times that."""
+        count = len(self._get(only_from))
+        since = time_lib.monotonic()
+
+        def settled() -> bool:
+            nonlocal count, since
+            new_count = len(self._get(only_from))
+            if new_count != count:
+                count, since = new_count, time_lib.monotonic()
+            return time_lib.monotonic() - since >= quiet
+
+        poll_until(settled, timeout=quiet * 4, backoff=1)
+
     def _get(self, only_from: str | None = None) -> list[Any]:
         r = requests.get(f"http://{self._host}:{self._PORT}/api/emails", timeout=60)
         r.raise_for_status()
@@ -414,8 +1092,16 @@ class Email:
         self,
         emails: Sequence[Mapping[str, str]],
         only_from: str | None = None,
+        timeout: float = 0,
+        quiet: float = 5,
     ) -> None:
-        """Emails must exactly match."""
+        """Emails must exactly match, once as many have arrived or timeout seconds pass.
+
+        Once as many have arrived, waits for quiet seconds without a new one, so an extra email
+        that arrives late still fails.
+        """
+        if poll_until(self.received(len(emails), only_from), timeout):
+            self._wait_quiet(quiet, only_from)
         got_emails = self._get(only_from)
 
         if len(got_emails) != len(emails):
@@ -432,25 +1118,32 @@ class Email:
             if not matches:
                 pytest.fail(msg)
 
+    def _unmatched(
+        self,
+        emails: Sequence[Mapping[str, str]],
+        got_emails: Sequence[Mapping[str, Any]],
+    ) -> list[Mapping[str, str]]:
+        return [
+            expected
+            for expected in sorted(emails, key=lambda e: e["subject_re"])
+            if not any(self._matches(expected, email)[0] for email in got_emails)
+        ]
+
     def assert_has_emails(
         self,
         emails: Sequence[Mapping[str, str]],
         only_from: str | None = None,
+        timeout: float = 0,
     ) -> None:
-        """Emails must be a subset of what's on the server."""
+        """Emails must be a subset of what's on the server, within timeout seconds."""
+        poll_until(lambda: not self._unmatched(emails, self._get(only_from)), timeout)
         got_emails = sorted(self._get(only_from), key=lambda e: cast("str", e["subject"]))
 
-        for expected in sorted(emails, key=lambda e: e["subject_re"]):
-            found = False
-            for email in got_emails:
-                if self._matches(expected, email)[0]:
-                    found = True
-                    break
-            if not found:
-                pytest.fail(
-                    f"Found no email matching:\n{expected}\nfull got:\n"
-                    + json.dumps(got_emails, sort_keys=True, indent=2),
-                )
+        for expected in self._unmatched(emails, got_emails):
+            pytest.fail(
+                f"Found no email matching:\n{expected}\nfull got:\n"
+                + json.dumps(got_emails, sort_keys=True, indent=2),
+            )
 
 
 class MockServer:
@@ -508,6 +1201,165 @@ class MockServer:
         self.assert_called(0)
 
 
+# Defines 'run I CHECK COMMAND', which evals COMMAND in the calling shell, so later commands see
+# its variables, and prints a line of its index, rc, and base64 stdout and stderr. Returns
+# nonzero if CHECK is 1 and the command failed, so the batch can stop there.
+_BATCH_FUNCTION = """
+__batch_dir="$(mktemp -d)"
+trap 'rm -rf "${__batch_dir}"' EXIT
+run() {
+    eval "$3" </dev/null >"${__batch_dir}/out" 2>"${__batch_dir}/err"
+    local __batch_rc="$?"
+    echo "### $1 ${__batch_rc} $(base64 -w 0 <"${__batch_dir}/out") \\
+$(base64 -w 0 <"${__batch_dir}/err")"
+    [ "$2" = 0 ] || [ "${__batch_rc}" = 0 ]
+}
+"""
+
+
+class BatchResult:
+    """The result of a command in a Batch; only set once the batch has run."""
+
+    def __init__(self, command: str) -> None:
+        super().__init__()
+        self.command = command
+        self._rc: int | None = None
+        self._stdout = ""
+        self._stderr = ""
+
+    def _set(self, rc: int, stdout: str, stderr: str) -> None:
+        self._rc = rc
+        self._stdout = stdout
+        self._stderr = stderr
+
+    @property
+    def ran(self) -> bool:
+        return self._rc is not None
+
+    def _check_ran(self) -> None:
+        if self._rc is None:
+            raise ValueError(f"'{self.command}' hasn't run")
+
+    @property
+    def rc(self) -> int:
+        self._check_ran()
+        return cast("int", self._rc)
+
+    @property
+    def stdout(self) -> str:
+        self._check_ran()
+        return self._stdout
+
+    @property
+    def stderr(self) -> str:
+        self._check_ran()
+        return self._stderr
+
+    def __repr__(self) -> str:
+        if not self.ran:
+            return f"BatchResult(command={self.command!r})"
+        return (
+            f"BatchResult(command={self.command!r}, rc={self._rc}, stdout={self._stdout!r}, "
+            f"stderr={self._stderr!r})"
+        )
+
+
+class Batch:
+    """Queues commands and runs them all over one SSH connection when the context exits.
+
+    Commands run in order in the same shell, so they can share variables. Like check_output, a
+    checked command that fails stops the batch and raises; unchecked commands just record their
+    rc. Commands mustn't call exit, which would end the whole batch. Results can be read after
+    the context exits. Use inside 'host.sudo()' to run as root.
+    """
+
+    def __init__(self, host: Host) -> None:
+        super().__init__()
+        self._host = host
+        self._commands: list[tuple[BatchResult, bool]] = []
+
+    def run(self, command: str, *args: str, check: bool = True) -> BatchResult:
+        if args:
+            command %= tuple(shlex.quote(arg) for arg in args)
+        result = BatchResult(command)
+        self._commands.append((result, check))
+        return result
+
+    def __enter__(self) -> "Batch":
+        return self
+
+    def __exit__(self, exc_type: type[BaseException] | None, *exc_info: object) -> None:
+        if exc_type is None and self._commands:
+            self._run()
+
+    @timer
+    def _run(self) -> None:
+        script = [_BATCH_FUNCTION]
+        script.extend(
+            f"run {i} {int(check)} {shlex.quote(result.command)} || exit 0"
+            for i, (result, check) in enumerate(self._commands)
+        )
+        out = self._host.run("bash -c %s", "\n".join(script))
+        for line in out.stdout.splitlines():
+            if line.startswith("### "):
+                i, rc, stdout, stderr = line.split(" ")[1:]
+                self._commands[int(i)][0]._set(  # noqa: SLF001
+                    int(rc),
+                    base64.b64decode(stdout).decode(errors="replace"),
+                    base64.b64decode(stderr).decode(errors="replace"),
+                )
+        for result, check in self._commands:
+            if not result.ran:
+                raise AssertionError(f"Batch didn't run '{result.command}': {out}")
+            if check and result.rc != 0:
+                raise AssertionError(f"Unexpected exit code {result.rc} for {result}")
+
+
+def _shadow(host: Host, kind: str, paths: Sequence[str]) -> None:
+    """Shadows all of paths in one go, or none of them if any fails."""
+    with host.sudo():
+        host.check_output(
+            "testbed-shadow shadow" + " %s %s" * len(paths),
+            *(arg for path in paths for arg in (kind, path)),
+        )
+
+
+def _restore(host: Host, paths: Sequence[str]) -> None:
+    with host.sudo():
+        host.check_output("testbed-shadow restore" + " %s" * len(paths), *paths)
+
+
+def recover_shadows(host: Host) -> str:
+    """Restores anything an aborted run left shadowed; returns what was restored."""
+    with host.sudo():
+        return host.check_output("testbed-shadow recover")
+
+
+class ShadowFiles:
+    """Creates empty files in place of paths; restores their contents on exit.
+
+    This lets tests modify the files' content without messing up the original
+    content. Shadows persist across reboots. All the files are shadowed and
+    restored in one round trip.
+    """
+
+    def __init__(self, host: Host, *paths: str) -> None:
+        super().__init__()
+        self._host = host
+        self._paths = paths
+        self._shadowed = False
+
+    def __enter__(self) -> list[File]:
+        _shadow(self._host, "file", self._paths)
+        self._shadowed = True
+        return [self._host.file(path) for path in self._paths]
+
+    def __exit__(self, *exc_info: object) -> None:
+        if self._shadowed:
+            _restore(self._host, self._paths)
+            self._shadowed = False
+
+
 class ShadowFile:
     """Creates an empty file in place of path; restores path's contents on exit.
 
@@ -517,40 +1369,14 @@ class ShadowFile:
 
     def __init__(self, host: Host, path: str) -> None:
         super().__init__()
-        self._host = host
         self._path = path
-        self._path_existed = False
-        self._backup_path = self._path + ".backup"
-        self._backup_file = self._host.file(self._backup_path)
+        self._shadow = ShadowFiles(host, path)
 
     def __enter__(self) -> File:
-        f = self._host.file(self._path)
-        self._path_existed = f.exists
-
-        if self._path_existed:
-            if self._backup_file.exists:
-                raise ValueError(
-                    f"Cannot shadow '{self._path}' because backup file '{self._backup_path}' "
-                    "already exists. Fix it manually.",
-                )
-            with self._host.sudo():
-                self._host.check_output(f"cp -p {self._path} {self._backup_path}")
-        else:
-            with self._host.sudo():
-                self._host.check_output(f"touch {self._path}")
-
-        with self._host.sudo():
-            f.clear()
-        return f
+        return self._shadow.__enter__()[0]
 
     def __exit__(self, *exc_info: object) -> None:
-        if self._path_existed:
-            if self._backup_file.exists:
-                with self._host.sudo():
-                    self._host.check_output(f"mv {self._backup_path} {self._path}")
-        else:
-            with self._host.sudo():
-                self._host.check_output(f"rm {self._path}")
+        self._shadow.__exit__(*exc_info)
 
     @property
     def path(self) -> str:
@@ -568,23 +1394,17 @@ class ShadowDir:
         super().__init__()
         self._host = host
         self._path = path
-        self._tmpdir: str | None = None
+        self._shadowed = False
 
     def __enter__(self) -> "ShadowDir":
-        with self._host.sudo():
-            tmpdir = self._host.check_output("mktemp -d")
-            self._host.check_output(f"chown --reference={self._path} {tmpdir}")
-            self._host.check_output(f"chmod --reference={self._path} {tmpdir}")
-            self._host.check_output(f"getfacl {self._path} | setfacl --set-file=- {tmpdir}")
-            self._host.check_output(f"mount --bind {tmpdir} {self._path}")
-            self._tmpdir = tmpdir
+        _shadow(self._host, "dir", [self._path])
+        self._shadowed = True
         return self
 
     def __exit__(self, *exc_info: object) -> None:
-        if self._tmpdir:
-            with self._host.sudo():
-                self._host.check_output(f"umount {self._path}")
-                self._host.check_output(f"rm -r {self._tmpdir}")
+        if self._shadowed:
+            _restore(self._host, [self._path])
+            self._shadowed = False
 
     @property
     def path(self) -> str:
@@ -650,26 +1470,34 @@ class CronRunner:
             if self._disable_sources_list:
                 self._sources_list = self._host.shadow_file("/etc/apt/sources.list")
                 self._sources_list.__enter__()
-        # Large change to override cron's daylight-saving-time handling
-        self._time_control = self._host.time(datetime.time(hour=9), self._date)
+        self._time_control = self._host.time(self._time, self._date)
         self._time_control.__enter__()
-        time_lib.sleep(90)
-        # Wait for it to start
-        self._time_control.set_time(self._time, self._date)
-        self._host.check_output(
-            "timeout 60 bash -c "
-            f"\"while ! pgrep -x -f '{self._cmd_to_watch}'; do true; done\"; true",
+        # Restarting cron makes it forget the old time, rather than applying its handling of
+        # time jumps (e.g. for daylight saving), so it runs jobs as if this were the real time.
+        with self._host.sudo():
+            self._host.check_output("systemctl restart cron")
+        # Wait for it to start. Polling from the host over SSH would miss short jobs, so this
+        # loops on the VM. It may still finish too fast to be seen, which callers check for.
+        self._host.run(
+            "timeout 60 bash -c %s",
+            f"until pgrep -x -f '{self._cmd_to_watch}' >/dev/null; do true; done",
         )
 
     def __exit__(self, *exc_info: object) -> None:
-        # Wait for cron to finish
-        self._host.check_output(f"while pgrep -x -f '{self._cmd_to_watch}'; do true; done")
+        # Wait for cron to finish, and for everything it logged to be readable
+        wait_until(
+            process_running(self._host, self._cmd_to_watch, running=False),
+            timeout=60 * 60,
+            max_interval=5,
+        )
+        wait_until(cron_idle(self._host), timeout=60, backoff=1)
+        with self._host.sudo():
+            self._host.check_output("journalctl --sync")
         if self._time_control:
             self._time_control.__exit__(None)
         with self._host.sudo():
             if self._sources_list:
                 self._sources_list.__exit__(None)
-        time_lib.sleep(2)
 
 
 class Lines:
@@ -772,10 +1600,11 @@ class OpenVPN:
     @contextmanager
     def connect(self, hostname: str, service: str) -> Iterator[None]:
         host = self._hosts[hostname]
+        tuns = len(Lines(host.check_output("ip -o link show up type tun")))
         try:
             with host.sudo():
                 host.check_output(f"systemctl start '{service}'")
-            time_lib.sleep(20)
+            wait_until(tun_up(host, tuns + 1), timeout=60)
             yield
         finally:
             with host.sudo():
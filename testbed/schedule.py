@@ -0,0 +1,72 @@
+"""Orders testbed tests to change VM states as few times as possible.
+
+Kept free of the testbed's dependencies, so it can be unit tested with the utils.
+"""
+
+import itertools
+from collections.abc import Hashable, Iterable, Sequence, Set
+
+
+def vm_state_changes(start: Set[str], states: Iterable[Set[str]]) -> int:
+    """How many VMs go up or down going from start through each set of VMs that are down."""
+    changes = 0
+    current = start
+    for state in states:
+        changes += len(current ^ state)
+        current = state
+    return changes
+
+
+def order_vm_states(start: Set[str], states: Iterable[Set[str]]) -> list[frozenset[str]]:
+    """Orders the distinct sets of down VMs to go through them all with the fewest changes.
+
+    Exact (Held-Karp over the sets); there are only a handful of distinct sets.
+    """
+    nodes = sorted({frozenset(s) for s in states}, key=sorted)
+    # (visited bitmask, last) -> (changes, previous last)
+    best: dict[tuple[int, int], tuple[int, int | None]] = {
+        (1 << i, i): (len(start ^ node), None) for i, node in enumerate(nodes)
+    }
+    for visited in range(1, 1 << len(nodes)):
+        for last in range(len(nodes)):
+            if (visited, last) not in best:
+                continue
+            changes = best[(visited, last)][0]
+            for i, node in enumerate(nodes):
+                if visited & (1 << i):
+                    continue
+                key = (visited | (1 << i), i)
+                total = changes + len(nodes[last] ^ node)
+                if key not in best or total < best[key][0]:
+                    best[key] = (total, last)
+
+    if not nodes:
+        return []
+    visited = (1 << len(nodes)) - 1
+    end: int | None = min(range(len(nodes)), key=lambda i: best[(visited, i)][0])
+    order = []
+    while end is not None:
+        order.append(nodes[end])
+        previous = best[(visited, end)][1]
+        visited &= ~(1 << end)
+        end = previous
+    return order[::-1]
+
+
+def order_tests(start: Set[str], tests: Sequence[tuple[Hashable, Set[str]]]) -> list[int]:
+    """Orders tests, given as (group, VMs that are down), returning their indexes.
+
+    Each group, e.g. a module or class, keeps its place and its tests stay together, so
+    module- and class-scoped fixtures still set up once. Within a group, tests needing the same
+    VMs down run together, keeping their order, starting from the state the previous group left.
+    """
+    order: list[int] = []
+    current = frozenset(start)
+    for _, group in itertools.groupby(range(len(tests)), key=lambda i: tests[i][0]):
+        indexes = list(group)
+        states = [frozenset(tests[i][1]) for i in indexes]
+        rank = {state: r for r, state in enumerate(order_vm_states(current, states))}
+        indexes.sort(key=lambda i: rank[frozenset(tests[i][1])])
+        order.extend(indexes)
+        current = frozenset(tests[indexes[-1]][1])
+    return order
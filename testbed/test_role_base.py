@@ -2,8 +2,8 @@ import datetime
 import time
 from collections.abc import Mapping
 
-from conftest import for_host_types
-from helpers import Email, Lines
+from conftest import for_host_types, pristine, uses_vms
+from helpers import Email, Lines, prometheus_alert_firing, wait_until
 from testinfra.host import Host
 
 # ruff: noqa: PLR2004
@@ -55,7 +55,6 @@ class TestRoleBase:
         # SSH login emails are on by default, so we expect one email for logging in, and one for
         # the command we actually ran.
         host.check_output("/etc/pi-server/email/send-email foo bar")
-        time.sleep(10)
         email.assert_emails(
             [
                 {
@@ -75,6 +74,7 @@ class TestRoleBase:
                 },
             ],
             only_from=hostname,
+            timeout=20,
         )
 
         # Disable SSH login emails from our address, and we should only get one email.
@@ -82,7 +82,6 @@ class TestRoleBase:
             email.clear()
 
             host.check_output("/etc/pi-server/email/send-email foo bar")
-            time.sleep(10)
             email.assert_emails(
                 [
                     {
@@ -93,6 +92,9 @@ class TestRoleBase:
                     },
                 ],
                 only_from=hostname,
+                timeout=20,
+                # Long enough for a login email to arrive, if one is wrongly sent
+                quiet=10,
             )
 
         # Emails are sent when we connect to a network.
@@ -102,7 +104,6 @@ class TestRoleBase:
                 host.check_output("ip link set enp0s8 down")
                 host.check_output("ip link set enp0s8 up")
 
-            time.sleep(65)
             email.assert_emails(
                 [
                     {
@@ -113,6 +114,7 @@ class TestRoleBase:
                     },
                 ],
                 only_from=hostname,
+                timeout=120,
             )
 
     # SSH is partially tested by the fact we can still log in at all, and partially
@@ -158,11 +160,11 @@ groups:
             # textfile -> node exporter -> scrape -> prometheus -> alertmanager -> webhook
             email.clear()
             try:
-                with (
-                    host.shadow_file("/etc/pi-server/monitoring/rules.d/test.yml") as rules,
-                    host.shadow_file("/var/pi-server/monitoring/collect/test1.prom") as data1,
-                    host.shadow_file("/var/pi-server/monitoring/collect/test2.prom") as data2,
-                ):
+                with host.shadow_files(
+                    "/etc/pi-server/monitoring/rules.d/test.yml",
+                    "/var/pi-server/monitoring/collect/test1.prom",
+                    "/var/pi-server/monitoring/collect/test2.prom",
+                ) as (rules, data1, data2):
                     with host.sudo():
                         rules.write(textfile_alert)
                         host.check_output("chmod a=r /etc/pi-server/monitoring/rules.d/test.yml")
@@ -175,7 +177,8 @@ groups:
                             "# HELP pi_server_test_test foo\n"
                             'pi_server_test_test{job="test", foo="baz"} 1',
                         )
-                    time.sleep(120)  # prometheus scrapes every minute
+                    # prometheus scrapes every minute
+                    wait_until(prometheus_alert_firing(host, "TestAlert"), timeout=240)
                     email.assert_has_emails(
                         [
                             {
@@ -190,6 +193,7 @@ groups:
                             },
                         ],
                         only_from=hostname,
+                        timeout=60,
                     )
             finally:
                 with host.sudo():
@@ -200,7 +204,8 @@ groups:
             email.clear()
             try:
                 host.make_bigfile("bigfile", "/")
-                time.sleep(360)  # alert has a 2m trigger duration, plus scrape delay
+                # alert has a 2m trigger duration, plus scrape delay
+                wait_until(prometheus_alert_firing(host, "HostOutOfDiskSpace"), timeout=720)
                 email.assert_has_emails(
                     [
                         {
@@ -214,6 +219,7 @@ groups:
                         },
                     ],
                     only_from=hostname,
+                    timeout=60,
                 )
             finally:
                 host.check_output("rm -f bigfile")
@@ -226,15 +232,18 @@ groups:
                 with host.shadow_file("/etc/pi-server/monitoring/rules.d/test.yml") as rules:
                     with host.sudo():
                         rules.write(jobmissing_alerts)
-                        host.check_output("chmod a=r /etc/pi-server/monitoring/rules.d/test.yml")
-                        host.check_output("pkill -HUP prometheus")  # reload rules
-                        host.check_output("systemctl stop cron.service")
-                        host.check_output(
+                    with host.sudo(), host.batch() as b:
+                        b.run("chmod a=r /etc/pi-server/monitoring/rules.d/test.yml")
+                        b.run("pkill -HUP prometheus")  # reload rules
+                        b.run("systemctl stop cron.service")
+                        b.run(
                             "docker compose -f /etc/pi-server/monitoring/docker-compose.yml stop "
                             "grafana",
                         )
 
-                    time.sleep(360)  # absent takes a while to show up
+                    # absent takes a while to show up
+                    for alert in ("TestDockerJobMissing", "TestSystemdJobMissing"):
+                        wait_until(prometheus_alert_firing(host, alert), timeout=720)
                     email.assert_has_emails(
                         [
                             {
@@ -259,12 +268,13 @@ groups:
                             },
                         ],
                         only_from=hostname,
+                        timeout=60,
                     )
             finally:
-                with host.sudo():
-                    host.check_output("pkill -HUP prometheus")  # reload rules
-                    host.check_output("systemctl start cron.service")
-                    host.check_output(
+                with host.sudo(), host.batch() as b:
+                    b.run("pkill -HUP prometheus")  # reload rules
+                    b.run("systemctl start cron.service")
+                    b.run(
                         "docker compose -f /etc/pi-server/monitoring/docker-compose.yml start "
                         "grafana",
                     )
@@ -396,10 +406,12 @@ echo bar
 
             with (
                 host.group_membership("vagrant", "pi-server-monitoring-writers"),
-                host.shadow_file("/etc/systemd/system/fake1.service") as fake1_unit,
-                host.shadow_file("/etc/systemd/system/fake2.service") as fake2_unit,
-                host.shadow_file("/etc/systemd/system/pi-server-cron-cron1.service") as cron1_unit,
-                host.shadow_file("/etc/systemd/system/pi-server-cron-cron2.service") as cron2_unit,
+                host.shadow_files(
+                    "/etc/systemd/system/fake1.service",
+                    "/etc/systemd/system/fake2.service",
+                    "/etc/systemd/system/pi-server-cron-cron1.service",
+                    "/etc/systemd/system/pi-server-cron-cron2.service",
+                ) as (fake1_unit, fake2_unit, cron1_unit, cron2_unit),
                 host.shadow_dir("/etc/pi-server/cron/cron.d") as cron_dir,
                 host.shadow_dir("/etc/pi-server/cron/pause.d") as pause_dir,
                 host.disable_login_emails(),
@@ -410,9 +422,10 @@ echo bar
                         fake2_unit.write(service_unit_template)
                         cron1_unit.write(cron_unit_template.format("cron1", "root", "root"))
                         cron2_unit.write(cron_unit_template.format("cron2", "vagrant", "vagrant"))
-                        host.check_output("systemctl daemon-reload")
-                        host.check_output("systemctl start fake1.service")
-                        host.check_output("systemctl start fake2.service")
+                    with host.sudo(), host.batch() as b:
+                        b.run("systemctl daemon-reload")
+                        b.run("systemctl start fake1.service")
+                        b.run("systemctl start fake2.service")
 
                     fake1_service = host.service("fake1.service")
                     fake2_service = host.service("fake2.service")
@@ -810,6 +823,9 @@ echo bar
             )
 
     @for_host_types("pi", "ubuntu")
+    @uses_vms("internet")
+    # Counts updates, so packages left by an aborted run would break it
+    @pristine()
     def test_updates(
         self,
         hostname: str,
@@ -869,9 +885,10 @@ echo bar
                 check_state(1, 0)
 
                 # One not upgraded
-                internet.check_output("aptly repo add main aptly/pi-server-test_1.2_all.deb")
-                internet.check_output("aptly repo add main aptly/pi-server-test2_1_all.deb")
-                internet.check_output("aptly publish update main")
+                with internet.batch() as b:
+                    b.run("aptly repo add main aptly/pi-server-test_1.2_all.deb")
+                    b.run("aptly repo add main aptly/pi-server-test2_1_all.deb")
+                    b.run("aptly publish update main")
                 known_packages.append("pi-server-test2")
 
                 with host.run_crons(disable_sources_list=False):
@@ -4,7 +4,7 @@ from collections.abc import Mapping
 from urllib.parse import urlparse
 
 import requests
-from conftest import for_host_types
+from conftest import for_host_types, runs_alone
 from helpers import MockServer, Vagrant, WebDriver
 from selenium.webdriver.common.by import By
 from testinfra.host import Host
@@ -232,6 +232,7 @@ class TestRolePiCore:
         test(local, addr)
 
     @for_host_types("pi")
+    @runs_alone()
     def test_shutdownd(
         self,
         hostname: str,
@@ -6,8 +6,8 @@ from collections.abc import Iterator, Mapping, Sequence, Set
 from contextlib import contextmanager
 from urllib.parse import urlparse
 
-from conftest import for_host_types
-from helpers import Email, Lines, WebDriver
+from conftest import for_host_types, uses_vms
+from helpers import Email, Lines, WebDriver, prometheus_alert_firing, wait_until
 from selenium.webdriver.common.by import By
 from testinfra.host import Host
 
@@ -38,10 +38,10 @@ class TestRolePiFull:
         def temp_zpool() -> Iterator[None]:
             with host.shadow_file("/tmp/file1") as f1, host.shadow_file("/tmp/file2") as f2:
                 try:
-                    with host.sudo():
-                        host.check_output(f"dd if=/dev/zero of={f1.path} bs=100M count=1")
-                        host.check_output(f"dd if=/dev/zero of={f2.path} bs=100M count=1")
-                        host.check_output(f"zpool create test mirror {f1.path} {f2.path}")
+                    with host.sudo(), host.batch() as b:
+                        b.run(f"dd if=/dev/zero of={f1.path} bs=100M count=1")
+                        b.run(f"dd if=/dev/zero of={f2.path} bs=100M count=1")
+                        b.run(f"zpool create test mirror {f1.path} {f2.path}")
                     yield
                 finally:
                     with host.sudo():
@@ -58,26 +58,22 @@ class TestRolePiFull:
                     host.check_output("systemctl start cron")
 
         def clear_prometheus() -> None:
-            with host.sudo():
-                host.check_output(
-                    "docker compose -f /etc/pi-server/monitoring/docker-compose.yml down",
-                )
-                host.check_output("docker volume rm monitoring_prometheus-data")
-                host.check_output("docker volume rm monitoring_alertmanager-data")
-                host.check_output(
-                    "docker compose -f /etc/pi-server/monitoring/docker-compose.yml up -d",
-                )
+            with host.sudo(), host.batch() as b:
+                b.run("docker compose -f /etc/pi-server/monitoring/docker-compose.yml down")
+                b.run("docker volume rm monitoring_prometheus-data")
+                b.run("docker volume rm monitoring_alertmanager-data")
+                b.run("docker compose -f /etc/pi-server/monitoring/docker-compose.yml up -d")
 
         with host.disable_login_emails():
             # Test pool status
             with temp_zpool():
                 email.clear()
-                with host.sudo():
-                    host.check_output("dd if=/dev/urandom of=/tmp/file1 bs=10K count=1 seek=1")
-                    host.check_output("zpool scrub test")
-
-                time.sleep(7 * 60)
+                with host.sudo(), host.batch() as b:
+                    b.run("dd if=/dev/urandom of=/tmp/file1 bs=10K count=1 seek=1")
+                    b.run("zpool scrub test")
 
+                # zed reports the fault during the scrub; prometheus needs a scrape first
+                wait_until(prometheus_alert_firing(host, "ZfsPoolUnhealthy"), timeout=14 * 60)
                 email.assert_has_emails(
                     [
                         {
@@ -103,6 +99,7 @@ class TestRolePiFull:
                         },
                     ],
                     only_from=hostname,
+                    timeout=60,
                 )
 
             # Test snapshots
@@ -113,8 +110,7 @@ class TestRolePiFull:
                     host.check_output(f"zfs snapshot test@{int(now.timestamp())}")
 
                 with host.time((now + datetime.timedelta(hours=2)).time()):
-                    time.sleep(5 * 60)
-
+                    wait_until(prometheus_alert_firing(host, "ZfsSnapshotTooOld"), timeout=10 * 60)
                     email.assert_has_emails(
                         [
                             {
@@ -128,6 +124,7 @@ class TestRolePiFull:
                             },
                         ],
                         only_from=hostname,
+                        timeout=60,
                     )
 
             # Test scrubbing
@@ -142,8 +139,10 @@ class TestRolePiFull:
                         # Big time jumps confuse prometheus, so delete its data.
                         clear_prometheus()
 
-                        time.sleep(5 * 60)
-
+                        wait_until(
+                            prometheus_alert_firing(host, "ZfsScrubTooOld"),
+                            timeout=10 * 60,
+                        )
                         email.assert_has_emails(
                             [
                                 {
@@ -157,6 +156,7 @@ class TestRolePiFull:
                                 },
                             ],
                             only_from=hostname,
+                            timeout=60,
                         )
             finally:
                 # Big time jumps confuse prometheus, so delete its data.
@@ -363,6 +363,7 @@ class TestRolePiFull:
         test(hostname + ".local")
 
     @for_host_types("pi")
+    @uses_vms("internet")
     def test_backup_git(
         self,
         hostname: str,
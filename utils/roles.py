@@ -1,28 +1,186 @@
 #!/usr/bin/env python3
 
+import argparse
+import hashlib
+import itertools
+import json
+import os
+import re
+import subprocess
 import sys
-from collections.abc import Mapping, Sequence
+import tempfile
+import time
+from collections.abc import Callable, Mapping, Sequence, Set
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
-from typing import cast
+from typing import Any, cast
 
 import yaml
 
+try:
+    from yaml import CSafeLoader as YamlLoader
+except ImportError:
+    from yaml import SafeLoader as YamlLoader  # type: ignore[assignment]
+
+# ruff: noqa: ANN401
+
 ROLE_PREFIX = "pi_server"
 BASE_ROLE = "pi_server.base"
-BASE_DEPENDENCY_EXEMPTIONS = frozenset({BASE_ROLE, "pi_server.role_helpers"})
+HELPERS_ROLE = "pi_server.role_helpers"
+BASE_DEPENDENCY_EXEMPTIONS = frozenset({BASE_ROLE, HELPERS_ROLE})
+# Task files that roles reach indirectly through vars set by the helpers role
+HELPERS_INCLUDES = {
+    "{{ define_role }}": "define_role.yml",
+    "{{ _pi_server_role_helpers_define_role_internal }}": "define_role_internal.yml",
+}
+
+CACHE_PATH = Path(__file__).resolve().parent.parent / ".roles-cache.json"
+CACHE_VERSION = 1
+# Below this many cache misses, starting a process pool costs more than it saves
+PARALLEL_PARSE_THRESHOLD = 16
+
+STATE_PATH = Path(__file__).resolve().parent.parent / ".roles-state.json"
+STATE_VERSION = 1
+# Directories whose files ansible templates, so may reference vars
+TEMPLATED_DIRS = ("defaults", "handlers", "meta", "tasks", "templates", "vars")
+IDENTIFIER = re.compile(r"[A-Za-z_][A-Za-z0-9_]*")
+
+ONLY_ROLES_VAR = "pi_server_role_helpers_only_roles"
+
+
+def _parse_yaml(content: bytes) -> Any:
+    return yaml.load(content, Loader=YamlLoader)
+
+
+def _json_safe(doc: Any) -> bool:
+    """Whether doc comes back from JSON unchanged; e.g. YAML dates and int keys don't."""
+    try:
+        return bool(json.loads(json.dumps(doc)) == doc)
+    except (TypeError, ValueError):
+        return False
+
+
+def _valid_entry(entry: Any) -> bool:
+    return (
+        isinstance(entry, dict)
+        and isinstance(entry.get("mtime_ns"), int)
+        and isinstance(entry.get("size"), int)
+        and isinstance(entry.get("sha256"), str)
+        and "doc" in entry
+    )
+
+
+class YamlCache:
+    """Parsed YAML files, persisted on disk between runs.
+
+    Entries are keyed by path, and are reused if the file's mtime and size are
+    unchanged, or if its content hash is unchanged. Misses are parsed in parallel. Files
+    that don't survive a JSON round trip are parsed every time, and a cache file that
+    isn't in the expected shape is ignored.
+    """
+
+    def __init__(self, path: Path | None = CACHE_PATH) -> None:
+        super().__init__()
+        self._path = path
+        self._entries: dict[str, dict[str, Any]] = {}
+        self._dirty = False
+        self._hits = 0
+        self._misses = 0
+        if self._path is not None and self._path.exists():
+            try:
+                data = json.loads(self._path.read_text())
+            except ValueError:
+                data = None
+            if (
+                isinstance(data, dict)
+                and data.get("version") == CACHE_VERSION
+                and isinstance(data.get("entries"), dict)
+            ):
+                self._entries = {k: v for k, v in data["entries"].items() if _valid_entry(v)}
+
+    @property
+    def hits(self) -> int:
+        return self._hits
+
+    @property
+    def misses(self) -> int:
+        return self._misses
+
+    def load(self, paths: Sequence[Path]) -> dict[Path, Any]:
+        out: dict[Path, Any] = {}
+        to_parse: list[tuple[Path, os.stat_result, str, bytes]] = []
+        for path in paths:
+            stat = path.stat()
+            entry = self._entries.get(str(path))
+            if (
+                entry is not None
+                and entry["mtime_ns"] == stat.st_mtime_ns
+                and entry["size"] == stat.st_size
+            ):
+                out[path] = entry["doc"]
+                self._hits += 1
+                continue
+
+            content = path.read_bytes()
+            sha256 = hashlib.sha256(content).hexdigest()
+            if entry is not None and entry["sha256"] == sha256:
+                out[path] = entry["doc"]
+                self._set(path, stat, sha256, entry["doc"])
+                self._hits += 1
+                continue
+
+            to_parse.append((path, stat, sha256, content))
+
+        contents = [content for _, _, _, content in to_parse]
+        if len(to_parse) >= PARALLEL_PARSE_THRESHOLD:
+            with ProcessPoolExecutor() as e:
+                docs = list(e.map(_parse_yaml, contents, chunksize=8))
+        else:
+            docs = [_parse_yaml(content) for content in contents]
+
+        for (path, stat, sha256, _), doc in zip(to_parse, docs, strict=True):
+            out[path] = doc
+            self._set(path, stat, sha256, doc)
+            self._misses += 1
+        return out
+
+    def _set(self, path: Path, stat: os.stat_result, sha256: str, doc: Any) -> None:
+        if not _json_safe(doc):
+            if self._entries.pop(str(path), None) is not None:
+                self._dirty = True
+            return
+        self._entries[str(path)] = {
+            "mtime_ns": stat.st_mtime_ns,
+            "size": stat.st_size,
+            "sha256": sha256,
+            "doc": doc,
+        }
+        self._dirty = True
+
+    def save(self) -> None:
+        if self._path is None or not self._dirty:
+            return
+        entries = {k: v for k, v in self._entries.items() if os.path.exists(k)}
+        # Write atomically, so concurrent runs never see a partial cache
+        fd, tmp = tempfile.mkstemp(dir=self._path.parent, prefix=self._path.name)
+        with os.fdopen(fd, "w") as f:
+            json.dump({"version": CACHE_VERSION, "entries": entries}, f)
+        os.replace(tmp, self._path)
+        self._dirty = False
 
 
 class Role:
-    def __init__(self, path: Path) -> None:
+    def __init__(self, path: Path, task_files: Mapping[str, Any]) -> None:
         super().__init__()
         self._path = path.resolve()
         self._tasks_dir = self._path / "tasks"
         self._name = self._path.name
         self._tidy_name = self._name.replace(".", "_")
         self._prefix = ".".join(self._name.split(".")[:-1])
+        self._task_files = dict(task_files)
         try:
-            self._parse_main()
-            self._parse_includes()
+            self._parse_main(task_files["main.yml"])
+            self._parse_includes(task_files)
         except ValueError as e:
             raise ValueError(f"Error loading role {self._name}: {e}") from e
 
@@ -66,8 +224,22 @@ class Role:
     def includes(self) -> frozenset[str]:
         return self._includes
 
-    def _parse_main(self) -> None:
-        tasks = yaml.safe_load((self._tasks_dir / "main.yml").read_text())
+    @property
+    def include_calls(self) -> list[tuple[str, frozenset[str]]]:
+        """Each include_role in the role's tasks, with the names of the vars it sets."""
+        return self._include_calls
+
+    @property
+    def sets_facts(self) -> bool:
+        """Whether the role's tasks set facts, which other roles may read."""
+        return self._sets_facts
+
+    @property
+    def task_files(self) -> Mapping[str, Any]:
+        """Parsed contents of each file in tasks/, by file name."""
+        return self._task_files
+
+    def _parse_main(self, tasks: Any) -> None:
         if len(tasks) != 1:
             raise ValueError(
                 f"main.yml must include exactly one task, calling define_role; got {len(tasks)}",
@@ -98,37 +270,47 @@ class Role:
         self._host_vars = cast("list[str]", task_vars["_host_vars"])
         self._export_vars = cast("list[str]", task_vars["_export_vars"])
 
-    def _parse_includes(self) -> None:
+    def _parse_includes(self, task_files: Mapping[str, Any]) -> None:
         includes = set()
-        for path in self._tasks_dir.iterdir():
-            if path.is_file():
-                tasks = yaml.safe_load(path.read_text())
-                if tasks:
-                    for task in tasks:
-                        if "ansible.builtin.include_role" in task:
-                            includes.add(task["ansible.builtin.include_role"]["name"])
+        include_calls = []
+        sets_facts = False
+        for tasks in task_files.values():
+            if tasks:
+                for task in tasks:
+                    if "ansible.builtin.include_role" in task:
+                        name = task["ansible.builtin.include_role"]["name"]
+                        includes.add(name)
+                        include_calls.append((name, frozenset(task.get("vars") or {})))
+                    if "ansible.builtin.set_fact" in task:
+                        sets_facts = True
         self._includes = frozenset(includes)
+        self._include_calls = include_calls
+        self._sets_facts = sets_facts
 
-    def validate(self, all_roles: Mapping[str, "Role"]) -> None:
+    def validate(self, all_roles: Mapping[str, "Role"], graph: "RoleGraph") -> None:
         for i in sorted(self._includes):
             if i.startswith(ROLE_PREFIX) and i not in all_roles:
                 raise ValueError(f"{self._name} depends on nonexistent role {i}")
-        if self._must_depend_on_base() and not self._depends_on_base(all_roles):
+        if self._must_depend_on_base() and BASE_ROLE not in graph.descendants(self._name):
             raise ValueError(f"{self._name} does not depend on {BASE_ROLE}")
+        for name, supplied in self._include_calls:
+            if name not in all_roles:
+                continue
+            callee = all_roles[name]
+            missing = [a for a in callee.args if a not in supplied]
+            if missing:
+                raise ValueError(f"{self._name} calls {name} without args {', '.join(missing)}")
+            if not callee.may_be_called_by(self._name):
+                raise ValueError(f"{self._name} calls {name}, which is private")
+
+    def may_be_called_by(self, name: str) -> bool:
+        """Whether the named role may call this one, which only matters if this one is private."""
+        caller_prefix = ".".join(name.split(".")[:-1])
+        return not self._private or self._prefix in {caller_prefix, name}
 
     def _must_depend_on_base(self) -> bool:
         return self._name not in BASE_DEPENDENCY_EXEMPTIONS and "testbed" not in self._name
 
-    def _depends_on_base(self, all_roles: Mapping[str, "Role"]) -> bool:
-        for i in sorted(self._includes):
-            if not i.startswith(ROLE_PREFIX):
-                continue
-            if i == BASE_ROLE:
-                return True
-            if all_roles[i]._depends_on_base(all_roles):  # noqa: SLF001
-                return True
-        return False
-
     def __repr__(self) -> str:
         out = (
             f"{self._name}\n  {self._tidy_name}\n  {self._path}\n"
@@ -153,27 +335,522 @@ class Role:
         return out
 
 
-def load_roles(roots: Sequence[str]) -> dict[str, Role]:
+class RoleGraph:
+    """Include relationships between roles.
+
+    Only includes of roles that exist are edges in the graph; includes of third-party roles
+    are kept separately, as leaves. Cycles are an error.
+    """
+
+    def __init__(self, roles: Mapping[str, Role]) -> None:
+        super().__init__()
+        self._includes: dict[str, frozenset[str]] = {
+            name: frozenset(i for i in r.includes if i in roles) for name, r in roles.items()
+        }
+        self._external_includes: dict[str, frozenset[str]] = {
+            name: frozenset(i for i in r.includes if not i.startswith(ROLE_PREFIX))
+            for name, r in roles.items()
+        }
+        included_by: dict[str, set[str]] = {name: set() for name in roles}
+        for name, includes in self._includes.items():
+            for i in includes:
+                included_by[i].add(name)
+        self._included_by = {name: frozenset(i) for name, i in included_by.items()}
+        self._order = self._topological_order()
+        self._descendants: dict[str, frozenset[str]] | None = None
+        self._ancestors: dict[str, frozenset[str]] | None = None
+
+    @property
+    def order(self) -> list[str]:
+        """All roles, each after every role it includes."""
+        return self._order
+
+    def includes(self, name: str) -> frozenset[str]:
+        return self._includes[name]
+
+    def external_includes(self, name: str) -> frozenset[str]:
+        return self._external_includes[name]
+
+    def included_by(self, name: str) -> frozenset[str]:
+        return self._included_by[name]
+
+    def descendants(self, name: str) -> frozenset[str]:
+        """All roles that name transitively includes."""
+        if self._descendants is None:
+            self._descendants = self._closure(self._order, self._includes)
+        return self._descendants[name]
+
+    def ancestors(self, name: str) -> frozenset[str]:
+        """All roles that transitively include name."""
+        if self._ancestors is None:
+            self._ancestors = self._closure(self._order[::-1], self._included_by)
+        return self._ancestors[name]
+
+    @staticmethod
+    def _closure(
+        order: Sequence[str],
+        edges: Mapping[str, frozenset[str]],
+    ) -> dict[str, frozenset[str]]:
+        # Each node's targets come before it in order, so their closures are already known
+        out: dict[str, frozenset[str]] = {}
+        for name in order:
+            reached = set(edges[name])
+            for target in edges[name]:
+                reached |= out[target]
+            out[name] = frozenset(reached)
+        return out
+
+    def _topological_order(self) -> list[str]:
+        # Iterative DFS, so deep include chains can't hit the recursion limit
+        order: list[str] = []
+        done: set[str] = set()
+        for root in sorted(self._includes):
+            if root in done:
+                continue
+            stack = [(root, iter(sorted(self._includes[root])))]
+            on_stack = {root}
+            while stack:
+                name, remaining = stack[-1]
+                for i in remaining:
+                    if i in on_stack:
+                        path = [n for n, _ in stack]
+                        cycle = [*path[path.index(i) :], i]
+                        raise ValueError("Found include cycle: " + " -> ".join(cycle))
+                    if i not in done:
+                        stack.append((i, iter(sorted(self._includes[i]))))
+                        on_stack.add(i)
+                        break
+                else:
+                    stack.pop()
+                    on_stack.remove(name)
+                    done.add(name)
+                    order.append(name)
+        return order
+
+
+class TaskCounts:
+    def __init__(self) -> None:
+        super().__init__()
+        self.tasks = 0
+        self.loops = 0
+        self.set_facts = 0
+
+    def add_task(self, task: Mapping[str, Any]) -> None:
+        self.tasks += 1
+        if "loop" in task:
+            self.loops += 1
+        if "ansible.builtin.set_fact" in task:
+            self.set_facts += 1
+
+    def add(self, other: "TaskCounts") -> None:
+        self.tasks += other.tasks
+        self.loops += other.loops
+        self.set_facts += other.set_facts
+
+    def to_json(self) -> dict[str, int]:
+        return {"tasks": self.tasks, "loops": self.loops, "set_facts": self.set_facts}
+
+
+class Invocation:
+    """One include of a role in a plan.
+
+    Tasks are counted once each, regardless of loops. 'own' counts tasks from the role's own
+    files; 'helpers' counts bookkeeping tasks, from main.yml and from the helpers role run on
+    the role's behalf; 'inclusive' also counts everything the role includes.
+    """
+
+    def __init__(self, role: str, depth: int, looped: bool, skipped: bool) -> None:
+        super().__init__()
+        self.role = role
+        self.depth = depth
+        self.looped = looped
+        self.skipped = skipped
+        self.own = TaskCounts()
+        self.helpers = TaskCounts()
+        self.inclusive = TaskCounts()
+
+    def to_json(self) -> dict[str, Any]:
+        return {
+            "role": self.role,
+            "depth": self.depth,
+            "looped": self.looped,
+            "skipped": self.skipped,
+            "own": self.own.to_json(),
+            "helpers": self.helpers.to_json(),
+            "inclusive": self.inclusive.to_json(),
+        }
+
+
+class Planner:
+    """Statically expands the include tree of a role into the roles it runs, in order.
+
+    Conditions are assumed to be true, and looped includes are expanded once. Roles with
+    _run_once are skipped after their first invocation, as define_role.yml does at runtime.
+    """
+
+    def __init__(self, roles: Mapping[str, Role]) -> None:
+        super().__init__()
+        if HELPERS_ROLE not in roles:
+            raise ValueError(f"Planning needs {HELPERS_ROLE} to be loaded")
+        self._roles = roles
+        self._helpers = roles[HELPERS_ROLE]
+        self._done: set[str] = set()
+        self._plan: list[Invocation] = []
+
+    def plan(self, name: str) -> list[Invocation]:
+        if name not in self._roles:
+            raise ValueError(f"Unknown role {name}")
+        self._done = set()
+        self._plan = []
+        self._invoke(name, 0, looped=False)
+        return self._plan
+
+    def _invoke(self, name: str, depth: int, looped: bool) -> Invocation:
+        role = self._roles[name]
+        invocation = Invocation(name, depth, looped, role.run_once and name in self._done)
+        self._plan.append(invocation)
+        self._run_file(invocation, role, "main.yml")
+        invocation.inclusive.add(invocation.own)
+        invocation.inclusive.add(invocation.helpers)
+        self._done.add(name)
+        return invocation
+
+    def _run_file(self, invocation: Invocation, role: Role, file_name: str) -> None:
+        if file_name not in role.task_files:
+            raise ValueError(f"{role.name} includes nonexistent task file {file_name}")
+        # main.yml only calls define_role, so it's bookkeeping too
+        helpers = role is self._helpers or file_name == "main.yml"
+        counts = invocation.helpers if helpers else invocation.own
+        for task in role.task_files[file_name] or []:
+            counts.add_task(task)
+            if "ansible.builtin.include_role" in task:
+                included = task["ansible.builtin.include_role"]["name"]
+                if included in self._roles:
+                    child = self._invoke(included, invocation.depth + 1, "loop" in task)
+                    invocation.inclusive.add(child.inclusive)
+            elif "ansible.builtin.include_tasks" in task:
+                included = task["ansible.builtin.include_tasks"]
+                if included in HELPERS_INCLUDES:
+                    if HELPERS_INCLUDES[included] == "define_role_internal.yml" and (
+                        invocation.skipped
+                    ):
+                        continue
+                    self._run_file(invocation, self._helpers, HELPERS_INCLUDES[included])
+                elif role is self._helpers:
+                    # The helpers' relative includes resolve to the role being defined
+                    self._run_file(invocation, self._roles[invocation.role], included)
+                else:
+                    self._run_file(invocation, role, included)
+
+
+def print_plan(plan: Sequence[Invocation], as_json: bool) -> None:
+    top = plan[0]
+    by_role: dict[str, tuple[int, TaskCounts]] = {}
+    for invocation in plan:
+        count, counts = by_role.get(invocation.role, (0, TaskCounts()))
+        counts.add(invocation.own)
+        counts.add(invocation.helpers)
+        by_role[invocation.role] = (count + 1, counts)
+    ranked = sorted(by_role.items(), key=lambda item: (-item[1][1].tasks, item[0]))
+
+    if as_json:
+        print(
+            json.dumps(
+                {
+                    "role": top.role,
+                    "invocations": [i.to_json() for i in plan],
+                    "total": top.inclusive.to_json(),
+                    "by_role": [
+                        {"role": name, "invocations": count, **counts.to_json()}
+                        for name, (count, counts) in ranked
+                    ],
+                },
+                indent=2,
+            ),
+        )
+        return
+
+    own = TaskCounts()
+    helpers = TaskCounts()
+    for invocation in plan:
+        own.add(invocation.own)
+        helpers.add(invocation.helpers)
+
+    out = [f"{'tasks':>6} {'loops':>6} {'set_fact':>8} {'helpers':>8} {'incl.':>6}  role"]
+    for i in plan:
+        flags = (" [looped]" if i.looped else "") + (" [skipped: run once]" if i.skipped else "")
+        out.append(
+            f"{i.own.tasks:6} {i.own.loops:6} {i.own.set_facts:8} {i.helpers.tasks:8} "
+            f"{i.inclusive.tasks:6}  {'  ' * i.depth}{i.role}{flags}",
+        )
+    out.extend(
+        [
+            "",
+            f"Invocations: {len(plan)} ({sum(i.skipped for i in plan)} skipped as run once)",
+            f"Tasks: {top.inclusive.tasks} ({own.tasks} in roles, {helpers.tasks} in helpers)",
+            f"Loops: {top.inclusive.loops} ({own.loops} in roles, {helpers.loops} in helpers)",
+            f"set_fact: {top.inclusive.set_facts} ({own.set_facts} in roles, "
+            f"{helpers.set_facts} in helpers)",
+            "",
+            "Top roles by tasks, including helpers:",
+        ],
+    )
+    out.extend(
+        f"{counts.tasks:6}  {name} ({count} invocations)" for name, (count, counts) in ranked[:20]
+    )
+    print("\n".join(out))
+
+
+class Profile:
+    """Task timings from the pi_server_profile callback, attributed to roles.
+
+    Times are summed over hosts. A task's self time goes to the innermost role that included
+    it, split into time in the role's own tasks and time in define_role bookkeeping run on its
+    behalf. Its inclusive time goes to every role on its stack.
+    """
+
+    PLAYBOOK = "(playbook)"
+    HELPERS_FRAME = "[define_role]"
+
+    def __init__(
+        self,
+        roles: Mapping[str, Role],
+        graph: RoleGraph,
+        records: Sequence[Mapping[str, Any]],
+    ) -> None:
+        super().__init__()
+        self._roles = roles
+        self._graph = graph
+        self._records = records
+        self.own: dict[str, float] = {}
+        self.helpers: dict[str, float] = {}
+        self.inclusive: dict[str, float] = {}
+        self.tasks: dict[str, int] = {}
+        self.collapsed: dict[str, float] = {}
+        self.unknown_edges: set[tuple[str, str]] = set()
+        for record in records:
+            self._add(record)
+
+    def _owner(self, path: Path) -> str | None:
+        """The role whose directory contains path, if any."""
+        for parent in path.parents:
+            if parent.name in self._roles and self._roles[parent.name].path == parent:
+                return parent.name
+        return None
+
+    def _add(self, record: Mapping[str, Any]) -> None:
+        duration = record["end"] - record["start"]
+        stack = [r for r in record["roles"] if r in self._roles]
+        path = Path(record["path"].rsplit(":", 1)[0]).resolve()
+        owner = self._owner(path)
+        if not stack and owner is not None:
+            stack = [owner]
+        for caller, callee in itertools.pairwise(stack):
+            if callee not in self._graph.includes(caller):
+                self.unknown_edges.add((caller, callee))
+        # As in the planner, main.yml only calls define_role, so it's bookkeeping too
+        helpers = (owner == HELPERS_ROLE and (not stack or stack[-1] != HELPERS_ROLE)) or (
+            owner is not None and path == self._roles[owner].path / "tasks" / "main.yml"
+        )
+
+        innermost = stack[-1] if stack else self.PLAYBOOK
+        times = self.helpers if helpers else self.own
+        times[innermost] = times.get(innermost, 0) + duration
+        self.tasks[innermost] = self.tasks.get(innermost, 0) + 1
+        for name in {*stack, innermost}:
+            self.inclusive[name] = self.inclusive.get(name, 0) + duration
+
+        frames = [record["host"], *stack]
+        if helpers:
+            frames.append(self.HELPERS_FRAME)
+        frames.append(record["task"])
+        key = ";".join(f.replace(";", ",").replace("\n", " ") for f in frames)
+        self.collapsed[key] = self.collapsed.get(key, 0) + duration
+
+    def report(self, limit: int = 40) -> str:
+        total = sum(self.own.values()) + sum(self.helpers.values())
+        helpers = sum(self.helpers.values())
+        wall = 0.0
+        if self._records:
+            wall = max(r["end"] for r in self._records) - min(r["start"] for r in self._records)
+        hosts = len({r["host"] for r in self._records})
+
+        out = [
+            f"Wall time: {wall:.1f} s for {len(self._records)} tasks on {hosts} hosts",
+            f"Task time, summed over hosts: {total:.1f} s, of which define_role bookkeeping: "
+            f"{helpers:.1f} s ({100 * helpers / total if total else 0:.1f}%)",
+            "",
+            f"{'self':>9} {'helpers':>9} {'incl.':>9} {'tasks':>6}  role",
+        ]
+        names = sorted(
+            self.tasks,
+            key=lambda n: (-(self.own.get(n, 0) + self.helpers.get(n, 0)), n),
+        )
+        out.extend(
+            f"{self.own.get(n, 0):9.1f} {self.helpers.get(n, 0):9.1f} "
+            f"{self.inclusive.get(n, 0):9.1f} {self.tasks[n]:6}  {n}"
+            for n in names[:limit]
+        )
+        if self.unknown_edges:
+            out.extend(["", "Includes not in the role graph (log may be from a different tree):"])
+            out.extend(f"  {a} -> {b}" for a, b in sorted(self.unknown_edges))
+        return "\n".join(out)
+
+    def write_collapsed(self, path: Path) -> None:
+        """Writes stacks in the collapsed format used by flamegraph.pl, in milliseconds."""
+        with path.open("w", encoding="utf-8") as f:
+            for key, duration in sorted(self.collapsed.items()):
+                f.write(f"{key} {round(duration * 1000)}\n")
+
+
+def load_profile_log(path: Path) -> list[dict[str, Any]]:
+    with path.open(encoding="utf-8") as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+class VarIndex:
+    """Vars defined in each role's defaults or exported by it, and the roles referencing them.
+
+    A var is referenced by a role if its name appears anywhere in a file the role templates,
+    other than as a key in the role's own defaults.
+    """
+
+    def __init__(self, roles: Mapping[str, Role], cache: YamlCache | None = None) -> None:
+        super().__init__()
+        if cache is None:
+            cache = YamlCache()
+        self._roles = roles
+        defaults_paths = {
+            name: r.path / "defaults" / "main.yml"
+            for name, r in roles.items()
+            if (r.path / "defaults" / "main.yml").exists()
+        }
+        docs = cache.load(list(defaults_paths.values()))
+        cache.save()
+        self._defaults: dict[str, dict[str, Any]] = {
+            name: docs[path] or {} for name, path in defaults_paths.items()
+        }
+
+        self._references: dict[str, set[str]] = {}
+        for name, r in roles.items():
+            identifiers = set()
+            for d in TEMPLATED_DIRS:
+                for path in sorted((r.path / d).rglob("*")):
+                    if path.is_file() and path != defaults_paths.get(name):
+                        text = path.read_text(encoding="utf-8", errors="replace")
+                        identifiers.update(IDENTIFIER.findall(text))
+            for value in self._defaults.get(name, {}).values():
+                identifiers.update(IDENTIFIER.findall(json.dumps(value)))
+            for i in identifiers:
+                self._references.setdefault(i, set()).add(name)
+
+    def defaults(self, name: str) -> Mapping[str, Any]:
+        return self._defaults.get(name, {})
+
+    def references(self, var: str) -> frozenset[str]:
+        """Roles whose files reference var."""
+        return frozenset(self._references.get(var, set()))
+
+    def unused_exports(self) -> list[tuple[str, str]]:
+        """(role, var) for each exported var no other role references."""
+        return [
+            (name, var)
+            for name, r in sorted(self._roles.items())
+            # The helpers' tasks run as part of every role, so their exports are always read
+            if name != HELPERS_ROLE
+            for var in r.export_vars
+            if not self.references(var) - {name}
+        ]
+
+    def unused_defaults(self) -> list[tuple[str, str]]:
+        """(role, var) for each var in defaults that no role references."""
+        return [
+            (name, var)
+            for name in sorted(self._defaults)
+            for var in self._defaults[name]
+            if not self.references(var)
+        ]
+
+    def footprint(self, plan: Sequence[Invocation]) -> dict[str, int]:
+        """Facts the role helpers leave in hostvars after running plan, and their size."""
+        names = {i.role for i in plan if not i.skipped} | {HELPERS_ROLE}
+        roles = [self._roles[n] for n in sorted(names) if n in self._roles]
+        exports = [(r.name, v) for r in roles for v in r.export_vars]
+        args = [r for r in roles if r.args]
+        return {
+            "roles": len(roles),
+            # Saved args and done markers, plus the call stack
+            "facts": 2 * len(roles) + len(exports) + 1,
+            "exports": len(exports),
+            "export_bytes": sum(len(json.dumps(self.defaults(n).get(v))) for n, v in exports),
+            "args": len(args),
+            "args_read": sum(bool(self.references(f"{r.tidy_name}_args")) for r in args),
+        }
+
+
+def print_vars(index: VarIndex, footprints: Mapping[str, Mapping[str, int]], as_json: bool) -> None:
+    unused_exports = index.unused_exports()
+    unused_defaults = index.unused_defaults()
+    if as_json:
+        print(
+            json.dumps(
+                {
+                    "unused_exports": [{"role": n, "var": v} for n, v in unused_exports],
+                    "unused_defaults": [{"role": n, "var": v} for n, v in unused_defaults],
+                    "footprints": footprints,
+                },
+                indent=2,
+            ),
+        )
+        return
+
+    out = [f"Exported vars no other role reads ({len(unused_exports)}):"]
+    out.extend(f"  {n}: {v}" for n, v in unused_exports)
+    out.extend(["", f"Defaults no role reads ({len(unused_defaults)}):"])
+    out.extend(f"  {n}: {v}" for n, v in unused_defaults)
+    for name, f in footprints.items():
+        out.extend(
+            [
+                "",
+                f"Facts left per host by {name}: {f['facts']} from {f['roles']} roles",
+                f"  Exported vars: {f['exports']} ({f['export_bytes']} bytes untemplated)",
+                f"  Saved args: {f['args']} non-empty, of which {f['args_read']} read by name",
+            ],
+        )
+    print("\n".join(out))
+
+
+def load_roles(roots: Sequence[str], cache: YamlCache | None = None) -> dict[str, Role]:
+    if cache is None:
+        cache = YamlCache()
+
+    role_files: list[tuple[Path, list[Path]]] = []
+    for root in roots:
+        for path in sorted(Path(root).resolve().iterdir()):
+            tasks_dir = path / "tasks"
+            if path.is_dir() and (tasks_dir / "main.yml").exists():
+                role_files.append((path, sorted(p for p in tasks_dir.iterdir() if p.is_file())))
+    docs = cache.load([p for _, files in role_files for p in files])
+    cache.save()
+
     out: dict[str, Role] = {}
     tidy_names: dict[str, Role] = {}
-    for root in roots:
-        for path in Path(root).resolve().iterdir():
-            if path.is_dir() and (path / "tasks" / "main.yml").exists():
-                r = Role(path)
-                if r.name in out:
-                    raise ValueError(
-                        "Found duplicate role names at paths " + f"{r.path} and {out[r.name].path}",
-                    )
-                if r.tidy_name in tidy_names:
-                    raise ValueError(
-                        "Found duplicate role tidy names at paths "
-                        f"{r.path} and {tidy_names[r.tidy_name].path}",
-                    )
-                out[r.name] = r
+    for path, files in role_files:
+        r = Role(path, {p.name: docs[p] for p in files})
+        if r.name in out:
+            raise ValueError(
+                "Found duplicate role names at paths " + f"{r.path} and {out[r.name].path}",
+            )
+        if r.tidy_name in tidy_names:
+            raise ValueError(
+                "Found duplicate role tidy names at paths "
+                f"{r.path} and {tidy_names[r.tidy_name].path}",
+            )
+        out[r.name] = r
     return out
 
 
-def dependency_graph(roles: Mapping[str, Role]) -> None:
+def dependency_graph(roles: Mapping[str, Role], graph: RoleGraph) -> None:
     prefix_groups: dict[str, set[str]] = {}
     processed = set()
     for r in roles.values():
@@ -198,7 +875,7 @@ def dependency_graph(roles: Mapping[str, Role]) -> None:
     for name, group in prefix_groups.items():
         edges = set()
         for r_name in group:
-            for i in roles[r_name].includes:
+            for i in graph.includes(r_name) | graph.external_includes(r_name):
                 if i in group:
                     edges.add((r_name, i))
                 else:
@@ -220,23 +897,330 @@ def dependency_graph(roles: Mapping[str, Role]) -> None:
     print("\n".join(out))
 
 
-def main() -> None:
-    if len(sys.argv) < 3:  # noqa: PLR2004
-        raise ValueError("Usage: ./roles.py command roots...")
+def benchmark(roots: Sequence[str], repeats: int = 5) -> None:
+    """Times loading roles with no cache, a cold cache and a warm cache."""
+
+    def run(make_cache: Callable[[], YamlCache]) -> tuple[float, YamlCache]:
+        cache = make_cache()
+        start = time.perf_counter()
+        roles = load_roles(roots, cache)
+        validate(roles)
+        return time.perf_counter() - start, cache
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        cache_path = Path(tmpdir) / "cache.json"
+
+        def cold() -> YamlCache:
+            cache_path.unlink(missing_ok=True)
+            return YamlCache(cache_path)
 
-    command = sys.argv[1]
-    if command not in {"lint", "deps"}:
-        raise ValueError(f"Unknown command {command}")
+        results = {
+            "uncached": [run(lambda: YamlCache(None)) for _ in range(repeats)],
+            "cold": [run(cold) for _ in range(repeats)],
+            "warm": [run(lambda: YamlCache(cache_path)) for _ in range(repeats)],
+        }
 
-    roles = load_roles(sys.argv[2:])
+    print(f"YAML loader: {YamlLoader.__name__}")
+    for name, runs in results.items():
+        times = sorted(t for t, _ in runs)
+        cache = runs[-1][1]
+        print(
+            f"{name:>8}: min {times[0] * 1000:8.1f} ms, median {times[len(times) // 2] * 1000:8.1f}"
+            f" ms ({cache.hits} hits, {cache.misses} misses)",
+        )
+
+
+def validate(roles: Mapping[str, Role], only: Set[str] | None = None) -> RoleGraph:
+    """Validates roles, or only the named roles; raises with all errors found."""
+    graph = RoleGraph(roles)
+    errors = []
+    for name in sorted(roles if only is None else only):
+        try:
+            roles[name].validate(roles, graph)
+        except ValueError as e:  # noqa: PERF203
+            errors.append(str(e))
+    if errors:
+        raise ValueError("\n".join(errors))
+    return graph
+
+
+def changed_paths(rev: str, cwd: Path) -> list[Path]:
+    """Paths changed in the working tree since rev, including untracked files."""
+
+    def git(*args: str) -> list[str]:
+        return subprocess.run(
+            ["git", *args],
+            cwd=cwd,
+            check=True,
+            capture_output=True,
+            text=True,
+        ).stdout.split("\0")
+
+    top = Path(git("rev-parse", "--show-toplevel")[0].strip())
+    names = git("diff", "--name-only", "--no-renames", "-z", rev, "--")
+    names += git("ls-files", "--others", "--exclude-standard", "-z")
+    return sorted({(top / name).resolve() for name in names if name})
+
+
+def affected_roles(
+    roles: Mapping[str, Role],
+    graph: RoleGraph,
+    roots: Sequence[str],
+    paths: Sequence[Path],
+) -> set[str] | None:
+    """Roles whose lint result may have changed, or None if all of them may have."""
+    changed = set()
+    for path in paths:
+        if path == Path(__file__).resolve():
+            return None
+        for root in roots:
+            root_path = Path(root).resolve()
+            if path.is_relative_to(root_path) and len(path.relative_to(root_path).parts) > 1:
+                changed.add(path.relative_to(root_path).parts[0])
+
+    # Raw reverse includes, so we can find the callers of roles that have been deleted
+    included_by: dict[str, set[str]] = {}
     for r in roles.values():
-        r.validate(roles)
+        for i in r.includes:
+            included_by.setdefault(i, set()).add(r.name)
+
+    out = set()
+    for name in changed:
+        directly = {name} if name in roles else included_by.get(name, set())
+        for r_name in directly:
+            out |= {r_name} | graph.ancestors(r_name)
+    return out
+
+
+def lint_changed(roots: Sequence[str], rev: str, cache: YamlCache | None = None) -> int:
+    """Validates only roles affected by changes since rev; returns how many were validated."""
+    roles = load_roles(roots, cache)
+    graph = RoleGraph(roles)
+    affected = affected_roles(roles, graph, roots, changed_paths(rev, Path(roots[0])))
+    validate(roles, affected)
+    validated = len(roles) if affected is None else len(affected)
+    print(
+        f"Validated {validated} roles changed since {rev} or depending on them; "
+        f"skipped {len(roles) - validated}",
+        file=sys.stderr,
+    )
+    return validated
+
+
+def _content_hash(path: Path) -> str:
+    """Hash of every file in a role, and its path relative to the role."""
+    h = hashlib.sha256()
+    for p in sorted(path.rglob("*")):
+        if p.is_file() and "__pycache__" not in p.parts:
+            h.update(str(p.relative_to(path)).encode() + b"\0")
+            h.update(hashlib.sha256(p.read_bytes()).digest())
+    return h.hexdigest()
+
+
+def fingerprints(roles: Mapping[str, Role], graph: RoleGraph) -> dict[str, str]:
+    """Hash of each role's content, folding in the hashes of the roles it includes.
+
+    Every role also folds in the role helpers, since they run as part of every role.
+    """
+    helpers = _content_hash(roles[HELPERS_ROLE].path) if HELPERS_ROLE in roles else ""
+    out: dict[str, str] = {}
+    for name in graph.order:
+        h = hashlib.sha256(f"{_content_hash(roles[name].path)}\0{helpers}\0".encode())
+        for i in sorted(graph.includes(name)):
+            h.update(f"{i}\0{out[i]}\0".encode())
+        for i in sorted(graph.external_includes(name)):
+            h.update(f"{i}\0".encode())
+        out[name] = h.hexdigest()
+    return out
+
+
+def _valid_hosts(hosts: Any) -> bool:
+    return isinstance(hosts, dict) and all(
+        isinstance(applied, dict)
+        and all(isinstance(k, str) and isinstance(v, str) for k, v in applied.items())
+        for applied in hosts.values()
+    )
 
-    if command == "lint":
+
+class DeployState:
+    """Fingerprints of the roles last successfully applied to each host.
+
+    A state file that isn't in the expected shape is ignored, so every role is stale.
+    """
+
+    def __init__(self, path: Path = STATE_PATH) -> None:
+        super().__init__()
+        self._path = path
+        self._hosts: dict[str, dict[str, str]] = {}
+        try:
+            with path.open(encoding="utf-8") as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            return
+        except ValueError:
+            data = None
+        if not isinstance(data, dict):
+            return
+        if data.get("version") != STATE_VERSION:
+            raise ValueError(f"Unsupported state file version in {path}")
+        if _valid_hosts(data.get("hosts")):
+            self._hosts = data["hosts"]
+
+    def applied(self, host: str) -> dict[str, str]:
+        return dict(self._hosts.get(host, {}))
+
+    def record(self, host: str, applied: Mapping[str, str]) -> None:
+        self._hosts.setdefault(host, {}).update(applied)
+
+    def save(self) -> None:
+        fd, tmp = tempfile.mkstemp(dir=self._path.parent, prefix=self._path.name)
+        with os.fdopen(fd, "w") as f:
+            json.dump({"version": STATE_VERSION, "hosts": self._hosts}, f, indent=2, sort_keys=True)
+        os.replace(tmp, self._path)
+
+
+def stale_roles(
+    graph: RoleGraph,
+    current: Mapping[str, str],
+    applied: Mapping[str, str],
+    name: str,
+) -> list[str]:
+    """Roles run by name whose fingerprint differs from the one last applied."""
+    scope = graph.descendants(name) | {name}
+    return [r for r in graph.order if r in scope and applied.get(r) != current[r]]
+
+
+def only_roles(
+    roles: Mapping[str, Role],
+    graph: RoleGraph,
+    root: str,
+    stale: Sequence[str],
+) -> list[str]:
+    """Roles in root whose tasks must run to deploy just the stale roles.
+
+    Roles that set facts always run, since stale roles may read the facts. A role is only
+    reached if the roles that include it run, so their ancestors run too.
+    """
+    needed = set(stale) | {n for n, r in roles.items() if r.sets_facts}
+    for name in list(needed):
+        needed |= graph.ancestors(name)
+    needed &= graph.descendants(root) | {root}
+    needed |= {root, HELPERS_ROLE}
+    return [r for r in graph.order if r in needed]
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    p = subparsers.add_parser("lint")
+    p.add_argument(
+        "--changed",
+        metavar="REV",
+        help="only validate roles affected by changes since REV",
+    )
+    p.add_argument("roots", nargs="+")
+    subparsers.add_parser("deps").add_argument("roots", nargs="+")
+    subparsers.add_parser("bench").add_argument("roots", nargs="+")
+    p = subparsers.add_parser("plan")
+    p.add_argument("--json", action="store_true")
+    p.add_argument("role")
+    p.add_argument("roots", nargs="+")
+    p = subparsers.add_parser("profile")
+    p.add_argument(
+        "--collapsed",
+        metavar="FILE",
+        type=Path,
+        help="also write collapsed stacks for flame graphs to FILE",
+    )
+    p.add_argument("log", type=Path, help="log written by the pi_server_profile callback")
+    p.add_argument("roots", nargs="+")
+    p = subparsers.add_parser("vars")
+    p.add_argument("--json", action="store_true")
+    p.add_argument(
+        "--footprint",
+        metavar="ROLE",
+        action="append",
+        default=[],
+        help="also count the facts left on hosts that run ROLE; may be repeated",
+    )
+    p.add_argument("roots", nargs="+")
+    for command in ("stale", "record"):
+        p = subparsers.add_parser(command)
+        p.add_argument(
+            "--state",
+            type=Path,
+            default=STATE_PATH,
+            help="file recording what was applied to each host",
+        )
+        if command == "stale":
+            p.add_argument(
+                "--extra-vars",
+                action="store_true",
+                help="print extra vars for ansible-playbook instead of role names",
+            )
+        p.add_argument("host", help="inventory hostname")
+        p.add_argument("role", help="top-level role deployed to host")
+        p.add_argument("roots", nargs="+")
+    for command in ("descendants", "ancestors"):
+        p = subparsers.add_parser(command)
+        p.add_argument("role")
+        p.add_argument("roots", nargs="+")
+    args = parser.parse_args()
+
+    if args.command == "bench":
+        benchmark(args.roots)
+        return
+    if args.command == "lint" and args.changed:
+        lint_changed(args.roots, args.changed)
+        return
+
+    roles = load_roles(args.roots)
+    graph = validate(roles)
+
+    if args.command == "lint":
         # Loading and validating is all we have to do here
         pass
-    elif command == "deps":
-        dependency_graph(roles)
+    elif args.command == "deps":
+        dependency_graph(roles, graph)
+    elif args.command == "plan":
+        print_plan(Planner(roles).plan(args.role), args.json)
+    elif args.command == "profile":
+        profile = Profile(roles, graph, load_profile_log(args.log))
+        print(profile.report())
+        if args.collapsed:
+            profile.write_collapsed(args.collapsed)
+    elif args.command == "vars":
+        index = VarIndex(roles)
+        planner = Planner(roles)
+        footprints = {name: index.footprint(planner.plan(name)) for name in args.footprint}
+        print_vars(index, footprints, args.json)
+    elif args.command in {"stale", "record"}:
+        if args.role not in roles:
+            raise ValueError(f"Unknown role {args.role}")
+        state = DeployState(args.state)
+        current = fingerprints(roles, graph)
+        stale = stale_roles(graph, current, state.applied(args.host), args.role)
+        if args.command == "record":
+            state.record(args.host, {r: current[r] for r in stale})
+            state.save()
+            print(f"Recorded {len(stale)} roles as applied to {args.host}", file=sys.stderr)
+        else:
+            print(
+                f"{len(stale)} of {len(graph.descendants(args.role)) + 1} roles in {args.role} "
+                f"changed since last recorded deploy to {args.host}",
+                file=sys.stderr,
+            )
+            if args.extra_vars:
+                print(json.dumps({ONLY_ROLES_VAR: only_roles(roles, graph, args.role, stale)}))
+            else:
+                for name in stale:
+                    print(name)
+    elif args.command in {"descendants", "ancestors"}:
+        if args.role not in roles:
+            raise ValueError(f"Unknown role {args.role}")
+        query = graph.descendants if args.command == "descendants" else graph.ancestors
+        for name in sorted(query(args.role)):
+            print(name)
 
 
 if __name__ == "__main__":
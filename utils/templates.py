@@ -0,0 +1,443 @@
+#!/usr/bin/env python3
+
+import argparse
+import ast
+import hashlib
+import json
+import re
+import shutil
+import subprocess
+import sys
+import time
+from collections.abc import Iterator, Mapping, Sequence, Set
+from pathlib import Path
+from typing import Any
+
+import yaml
+from ansible.parsing.dataloader import DataLoader
+from ansible.release import __version__ as ansible_version
+from ansible.template import Templar, generate_ansible_template_vars
+
+import roles
+
+# ruff: noqa: ANN401
+
+REPO = Path(__file__).resolve().parent.parent
+ROOTS = (str(REPO / "roles"), str(REPO / "testbed" / "roles"))
+TESTBED = REPO / "testbed"
+
+# How generic roles (e.g. pi_server.utils.systemd_service) render a template passed by the caller
+SRC_ARG = "{{ args.src }}"
+
+SLOWEST = 20
+
+# Templating changes a lot between ansible-core releases, so only the one in requirements.txt is
+# supported
+ANSIBLE_CORE = "2.16"
+
+BARE_VAR = re.compile(r"\{\{\s*([A-Za-z_]\w*)((?:\.\w+)*)\s*\}\}")
+
+
+class Placeholder(str):
+    """Stands in for a value only known at runtime, such as a registered var.
+
+    Any attribute or key of a placeholder is another placeholder, and loops over one are empty.
+    """
+
+    __slots__ = ()
+    # Stops ansible templating it, which would turn it back into a plain string
+    __UNSAFE__ = True
+
+    def __getattr__(self, name: str) -> "Placeholder":
+        if name.startswith("__"):
+            raise AttributeError(name)
+        return Placeholder(f"{self}.{name}")
+
+    def __getitem__(self, key: Any) -> Any:
+        if isinstance(key, str):
+            return Placeholder(f"{self}.{key}")
+        return super().__getitem__(key)
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(())
+
+
+class Args(dict[str, Any]):
+    """The 'args' of the role rendering a template; unknown args are placeholders."""
+
+    __UNSAFE__ = True
+
+    def __missing__(self, key: str) -> Placeholder:
+        return Placeholder(f"args.{key}")
+
+
+def _split_ruby_args(text: str) -> list[str]:
+    return [a.strip() for a in text.split(",")] if text.strip() else []
+
+
+def _ruby_to_python(text: str) -> str:
+    text = re.sub(r"\$(\w+)", r"\1", text)
+    text = re.sub(r"^(\s*)(\w+):", r'\1"\2":', text, flags=re.MULTILINE)
+    return re.sub(r"\b(true|false)\b", lambda m: m.group(1).capitalize(), text)
+
+
+def _ruby_value(text: str, names: Mapping[str, Any]) -> Any:
+    """Evaluates a ruby literal, which may also use names, index them and add strings."""
+
+    def value(node: ast.expr) -> Any:
+        if isinstance(node, ast.Constant):
+            return node.value
+        if isinstance(node, ast.Name):
+            return names[node.id]
+        if isinstance(node, ast.Subscript):
+            return value(node.value)[value(node.slice)]
+        if isinstance(node, ast.BinOp) and isinstance(node.op, ast.Add):
+            return value(node.left) + value(node.right)
+        if isinstance(node, ast.List):
+            return [value(e) for e in node.elts]
+        if isinstance(node, ast.Dict) and None not in node.keys:
+            return {value(k): value(v) for k, v in zip(node.keys, node.values, strict=True)}  # type: ignore[arg-type]
+        raise ValueError(f"Unsupported ruby: {ast.unparse(node)}")
+
+    return value(ast.parse(_ruby_to_python(text), mode="eval").body)
+
+
+def vagrant_hosts(
+    vagrantfile: Path = TESTBED / "Vagrantfile",
+) -> dict[str, tuple[str, dict[str, Any]]]:
+    """The playbook and extra vars each VM in the Vagrantfile is provisioned with, by name.
+
+    Only understands the subset of ruby the testbed's Vagrantfile uses.
+    """
+    with (vagrantfile.parent / "config.json").open(encoding="utf-8") as f:
+        config = json.load(f)
+    source = vagrantfile.read_text(encoding="utf-8")
+
+    defs = {}
+    for m in re.finditer(r"^def (\w+)\(([^)]*)\)\n(.*?)^end$", source, re.MULTILINE | re.DOTALL):
+        name, params, body = m.groups()
+        playbook = re.search(r'ansible\.playbook = "([^"]+)"', body)
+        extra_vars = re.search(
+            r"ansible\.extra_vars = (\{.*?^      \})",
+            body,
+            re.DOTALL | re.MULTILINE,
+        )
+        define = re.search(r"config\.vm\.define (\S+) do", body)
+        if playbook and extra_vars and define:
+            defs[name] = (
+                _split_ruby_args(params),
+                define.group(1),
+                playbook.group(1),
+                extra_vars.group(1),
+            )
+
+    out: dict[str, tuple[str, dict[str, Any]]] = {}
+    for call in re.finditer(r"^  (\w+) config(?:, (.*))?$", source, re.MULTILINE):
+        func, call_args = call.groups()
+        params, vm_expr, vm_playbook, vm_extra_vars = defs[func]
+        names = {"addrs": config["addrs"], "masks": config["masks"], "config": None}
+        for param, arg in zip(params, ["config", *_split_ruby_args(call_args or "")], strict=True):
+            names[param] = _ruby_value(arg, names)
+        out[_ruby_value(vm_expr, names)] = (vm_playbook, _ruby_value(vm_extra_vars, names))
+    return out
+
+
+def playbook_roles(path: Path) -> list[str]:
+    """Roles the playbook includes directly."""
+    with path.open(encoding="utf-8") as f:
+        plays = yaml.safe_load(f)
+    return [
+        task["ansible.builtin.include_role"]["name"]
+        for play in plays
+        for task in play.get("tasks", [])
+        if "ansible.builtin.include_role" in task
+    ]
+
+
+def runtime_names(all_roles: Mapping[str, roles.Role]) -> set[str]:
+    """Vars that only get values while tasks run: registered vars, facts, loop vars."""
+    out = {"item"}
+    for r in all_roles.values():
+        out.add(f"{r.tidy_name}_args")
+        for tasks in r.task_files.values():
+            for task in tasks or []:
+                if "register" in task:
+                    out.add(task["register"])
+                # Roles like pi_server.utils.user register their result under a name they're given
+                if "ansible.builtin.include_role" in task and (task.get("vars") or {}).get(
+                    "register",
+                ):
+                    out.add(task["vars"]["register"])
+                out.update(task.get("ansible.builtin.set_fact", {}))
+                out.add(task.get("loop_control", {}).get("loop_var", "item"))
+    return out
+
+
+def make_templar(variables: Mapping[str, Any]) -> Templar:
+    return Templar(loader=DataLoader(), variables=dict(variables))
+
+
+class Context:
+    """Vars a template is rendered with by one task: the task's own vars and the role's args."""
+
+    def __init__(self, task_vars: Mapping[str, Any], args: Args) -> None:
+        super().__init__()
+        self.task_vars = dict(task_vars)
+        self.args = args
+
+
+class Renderers:
+    """Which tasks render each template, following templates passed to generic roles as args."""
+
+    def __init__(self, all_roles: Mapping[str, roles.Role]) -> None:
+        super().__init__()
+        # Role -> (src, task vars) for each template task in it
+        self._templates: dict[str, list[tuple[str, dict[str, Any]]]] = {}
+        # Role -> (included role, task vars) for each include_role in it
+        self._includes: dict[str, list[tuple[str, dict[str, Any]]]] = {}
+        for name, r in all_roles.items():
+            for tasks in r.task_files.values():
+                for task in tasks or []:
+                    task_vars = task.get("vars") or {}
+                    if "ansible.builtin.template" in task:
+                        src = task["ansible.builtin.template"]["src"]
+                        self._templates.setdefault(name, []).append((src, task_vars))
+                    if "ansible.builtin.include_role" in task:
+                        included = task["ansible.builtin.include_role"]["name"]
+                        self._includes.setdefault(name, []).append((included, task_vars))
+
+    def contexts(self, templar: Templar, role: str, src: str) -> list[Context]:
+        """Contexts the template src in role's templates is rendered in.
+
+        Include vars are evaluated with templar, so they become the included role's args.
+        """
+        return self._contexts(templar, role, src, Args())
+
+    def _contexts(self, templar: Templar, role: str, src: str, args: Args) -> list[Context]:
+        out = [Context(v, args) for s, v in self._templates.get(role, []) if s == src]
+        for included, include_vars in self._includes.get(role, []):
+            if include_vars.get("src") == src:
+                included_args = self._evaluate(templar, include_vars, args)
+                out.extend(self._contexts(templar, included, SRC_ARG, included_args))
+        return out
+
+    @staticmethod
+    def _evaluate(templar: Templar, include_vars: Mapping[str, Any], args: Args) -> Args:
+        templar.environment.globals["args"] = args
+        out = Args()
+        for k, v in include_vars.items():
+            try:
+                out[k] = templar.template(v, fail_on_undefined=True)
+            except Exception:  # noqa: BLE001, PERF203
+                out[k] = Placeholder(f"args.{k}")
+        return out
+
+
+class Render:
+    def __init__(self, host: str, role: str, template: Path) -> None:
+        super().__init__()
+        self.host = host
+        self.role = role
+        self.template = template
+        self.seconds = 0.0
+        self.output = ""
+        self.error = ""
+
+    @property
+    def kind(self) -> str:
+        """Which check applies to the output: 'yaml', 'json', 'shell' or ''."""
+        name = self.template.name.removesuffix(".j2")
+        if name.endswith((".yml", ".yaml")):
+            return "yaml"
+        if name.endswith(".json"):
+            return "json"
+        if re.match(r"#!\s*\S*(/bash|/sh|/env bash)\b", self.output):
+            return "shell"
+        return ""
+
+    def to_json(self) -> dict[str, Any]:
+        return {
+            "host": self.host,
+            "role": self.role,
+            "template": str(self.template.relative_to(REPO)),
+            "seconds": self.seconds,
+            "error": self.error,
+        }
+
+
+def _placeholders(task_vars: Mapping[str, Any], runtime: Set[str]) -> dict[str, Any]:
+    """Task vars that are just a runtime var, as placeholders, so they still act like one."""
+    out = {}
+    for k, v in task_vars.items():
+        m = BARE_VAR.fullmatch(v) if isinstance(v, str) else None
+        out[k] = Placeholder(m.group(1) + m.group(2)) if m and m.group(1) in runtime else v
+    return out
+
+
+def render(
+    host: str,
+    role: roles.Role,
+    template: Path,
+    variables: Mapping[str, Any],
+    context: Context,
+    runtime: Set[str],
+) -> Render:
+    r = Render(host, role.name, template)
+    task_vars = _placeholders(context.task_vars, runtime)
+    templar = make_templar(
+        {**variables, **task_vars, **generate_ansible_template_vars(str(template))},
+    )
+    templar.environment.globals["args"] = context.args
+    source = template.read_text(encoding="utf-8")
+    start = time.perf_counter()
+    try:
+        # Like the template action: the output stays a string, and backslashes are left alone
+        r.output = str(
+            templar.template(
+                source,
+                preserve_trailing_newlines=True,
+                escape_backslashes=False,
+                fail_on_undefined=True,
+                convert_data=False,
+            ),
+        )
+    except Exception as e:  # noqa: BLE001
+        r.error = f"render: {e}"
+    r.seconds = time.perf_counter() - start
+    return r
+
+
+def host_vars(
+    index: roles.VarIndex,
+    names: Sequence[str],
+    extra_vars: Mapping[str, Any],
+    runtime: Set[str],
+) -> dict[str, Any]:
+    """Vars visible to templates on a host running the named roles, roughly."""
+    out: dict[str, Any] = {name: Placeholder(name) for name in sorted(runtime)}
+    for name in names:
+        out.update(index.defaults(name))
+    out.update(extra_vars)
+    out["inventory_hostname"] = extra_vars.get("pi_server_hostname", "localhost")
+    return out
+
+
+def check(renders: Sequence[Render]) -> None:
+    """Parses each successful render's output according to its kind, recording any error."""
+    scripts: dict[str, list[Render]] = {}
+    for r in renders:
+        if r.error:
+            continue
+        try:
+            if r.kind == "yaml":
+                list(yaml.safe_load_all(r.output))
+            elif r.kind == "json":
+                json.loads(r.output)
+        except (ValueError, yaml.YAMLError) as e:
+            r.error = f"{r.kind}: {e}"
+        if r.kind == "shell":
+            digest = hashlib.sha256(r.output.encode()).hexdigest()
+            scripts.setdefault(digest, []).append(r)
+
+    if not scripts:
+        return
+    if shutil.which("shellcheck") is None:
+        print("shellcheck not found; not checking scripts", file=sys.stderr)
+        return
+    for same in scripts.values():
+        result = subprocess.run(
+            ["shellcheck", "--format=gcc", "-"],
+            input=same[0].output,
+            capture_output=True,
+            text=True,
+            cwd=REPO,
+            check=False,
+        )
+        if result.returncode != 0:
+            for r in same:
+                r.error = "shellcheck: " + result.stdout.strip()
+
+
+def render_all(only_hosts: Sequence[str] = ()) -> list[Render]:
+    all_roles = roles.load_roles(ROOTS)
+    graph = roles.validate(all_roles)
+    index = roles.VarIndex(all_roles)
+    renderers = Renderers(all_roles)
+    runtime = runtime_names(all_roles)
+    renders: list[Render] = []
+    for host, (playbook, extra_vars) in sorted(vagrant_hosts().items()):
+        if only_hosts and host not in only_hosts:
+            continue
+        names: set[str] = set()
+        for name in playbook_roles(TESTBED / playbook):
+            names |= {name} | graph.descendants(name)
+        variables = host_vars(index, sorted(names), extra_vars, runtime)
+        templar = make_templar(variables)
+        for name in sorted(names):
+            role = all_roles[name]
+            templates_dir = role.path / "templates"
+            for template in sorted(templates_dir.rglob("*.j2")):
+                src = str(template.relative_to(templates_dir))
+                # Templates only rendered via a computed src get no task vars or args
+                contexts = renderers.contexts(templar, name, src) or [Context({}, Args())]
+                renders.extend(
+                    render(host, role, template, variables, c, runtime) for c in contexts
+                )
+    check(renders)
+    return renders
+
+
+def report(renders: Sequence[Render], slowest: int = SLOWEST) -> str:
+    failed = [r for r in renders if r.error]
+    total = sum(r.seconds for r in renders)
+    hosts = len({r.host for r in renders})
+    templates = len({r.template for r in renders})
+    out = [
+        f"Rendered {templates} templates {len(renders)} times for {hosts} hosts in "
+        f"{total:.2f} s; {len(failed)} renders failed",
+    ]
+    for r in failed:
+        out.extend(["", f"{r.template.relative_to(REPO)} on {r.host}:", f"  {r.error}"])
+
+    by_template: dict[Path, list[float]] = {}
+    for r in renders:
+        by_template.setdefault(r.template, []).append(r.seconds)
+    ranked = sorted(by_template.items(), key=lambda item: -max(item[1]))
+    out.extend(["", "Slowest templates (ms, max over renders):"])
+    out.extend(
+        f"{1000 * max(times):9.2f}  {path.relative_to(REPO)}" for path, times in ranked[:slowest]
+    )
+    return "\n".join(out)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description="Renders every role template offline with the testbed's vars, checks the "
+        "output parses, and times each render.",
+    )
+    parser.add_argument("--json", action="store_true")
+    parser.add_argument(
+        "--host",
+        action="append",
+        default=[],
+        help="only render for this testbed VM; may be repeated",
+    )
+    args = parser.parse_args()
+
+    if not ansible_version.startswith(ANSIBLE_CORE + "."):
+        sys.exit(
+            f"Needs ansible-core {ANSIBLE_CORE}.x, as in requirements.txt, but found "
+            f"{ansible_version}",
+        )
+
+    renders = render_all(args.host)
+    if args.json:
+        print(json.dumps([r.to_json() for r in renders], indent=2))
+    else:
+        print(report(renders))
+    if any(r.error for r in renders):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
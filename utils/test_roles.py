@@ -0,0 +1,508 @@
+import datetime
+import json
+import os
+import random
+import shutil
+import subprocess
+from collections.abc import Callable, Mapping, Sequence
+from pathlib import Path
+
+import roles
+
+HELPERS_PATH = Path(__file__).resolve().parent.parent / "roles" / roles.HELPERS_ROLE
+
+MAIN_YML = """- name: Define role
+  ansible.builtin.include_tasks: "{{ define_role }}"
+  vars:
+    _private: false
+    _run_once: {run_once}
+    _args: []
+    _host_vars: []
+    _export_vars: []
+"""
+
+
+def _write_role(
+    root: Path,
+    name: str,
+    includes: Sequence[str],
+    run_once: bool = False,
+) -> None:
+    tasks_dir = root / name / "tasks"
+    tasks_dir.mkdir(parents=True, exist_ok=True)
+    (tasks_dir / "main.yml").write_text(MAIN_YML.replace("{run_once}", str(run_once).lower()))
+    (tasks_dir / "tasks.yml").write_text(
+        "".join(f"- ansible.builtin.include_role:\n    name: {i}\n" for i in includes),
+    )
+
+
+def _synthetic_tree(root: Path, rng: random.Random) -> dict[str, list[str]]:
+    """A random valid tree of roles, where every app reaches the base role somehow."""
+    tree: dict[str, list[str]] = {roles.BASE_ROLE: [], "pi_server.role_helpers": []}
+    apps: list[str] = []
+    for i in range(20):
+        name = f"pi_server.apps.app{i}"
+        includes = rng.sample(apps, k=min(len(apps), rng.randint(0, 3)))
+        if not includes or rng.random() < 0.2:  # noqa: PLR2004
+            includes.append(roles.BASE_ROLE)
+        tree[name] = includes
+        apps.append(name)
+    for name, includes in tree.items():
+        _write_role(root, name, includes)
+    return tree
+
+
+def _git(root: Path, *args: str) -> None:
+    subprocess.run(
+        ["git", "-c", "user.name=test", "-c", "user.email=test@test", *args],
+        cwd=root,
+        check=True,
+        capture_output=True,
+    )
+
+
+def _verdict(f: Callable[[], object]) -> str:
+    try:
+        f()
+    except ValueError as e:
+        return str(e)
+    return ""
+
+
+def _lint_verdicts(root: Path) -> tuple[str, str]:
+    full = _verdict(lambda: roles.validate(roles.load_roles([str(root)], roles.YamlCache(None))))
+    changed = _verdict(lambda: roles.lint_changed([str(root)], "HEAD", roles.YamlCache(None)))
+    return full, changed
+
+
+def _mutations(root: Path, tree: Mapping[str, Sequence[str]]) -> dict[str, Callable[[], None]]:
+    apps = sorted(name for name in tree if name.startswith("pi_server.apps."))
+
+    def drop_includes() -> None:
+        for app in apps[::5]:
+            _write_role(root, app, [])
+
+    def nonexistent_include() -> None:
+        _write_role(root, apps[3], [*tree[apps[3]], "pi_server.apps.nonexistent"])
+
+    def delete_role() -> None:
+        shutil.rmtree(root / apps[2])
+
+    def new_role() -> None:
+        _write_role(root, "pi_server.apps.new", [apps[0]])
+
+    def new_role_without_base() -> None:
+        _write_role(root, "pi_server.apps.new", [])
+
+    def template() -> None:
+        (root / apps[7] / "templates").mkdir()
+        (root / apps[7] / "templates" / "foo.j2").write_text("foo")
+
+    return {
+        "drop includes": drop_includes,
+        "nonexistent include": nonexistent_include,
+        "delete role": delete_role,
+        "new role": new_role,
+        "new role without base": new_role_without_base,
+        "template": template,
+    }
+
+
+def test_yaml_cache(tmp_path: Path) -> None:
+    cache_path = tmp_path / "cache.json"
+    a = tmp_path / "a.yml"
+    b = tmp_path / "b.yml"
+    a.write_text("- foo: 1\n")
+    b.write_text("bar: [2, 3]\n")
+
+    cache = roles.YamlCache(cache_path)
+    assert cache.load([a, b]) == {a: [{"foo": 1}], b: {"bar": [2, 3]}}
+    assert (cache.hits, cache.misses) == (0, 2)
+    cache.save()
+
+    cache = roles.YamlCache(cache_path)
+    assert cache.load([a, b]) == {a: [{"foo": 1}], b: {"bar": [2, 3]}}
+    assert (cache.hits, cache.misses) == (2, 0)
+
+    # Changed content is parsed again; unchanged content with a new mtime isn't
+    a.write_text("- foo: 10\n")
+    b.write_text(b.read_text())
+    cache = roles.YamlCache(cache_path)
+    assert cache.load([a, b]) == {a: [{"foo": 10}], b: {"bar": [2, 3]}}
+    assert (cache.hits, cache.misses) == (1, 1)
+
+
+def test_yaml_cache_not_json(tmp_path: Path) -> None:
+    cache_path = tmp_path / "cache.json"
+    a = tmp_path / "a.yml"
+    a.write_text("when: 2024-01-02\n1: int key\n")
+    want = {"when": datetime.date(2024, 1, 2), 1: "int key"}
+
+    cache = roles.YamlCache(cache_path)
+    assert cache.load([a]) == {a: want}
+    cache.save()
+
+    cache = roles.YamlCache(cache_path)
+    assert cache.load([a]) == {a: want}
+    assert (cache.hits, cache.misses) == (0, 1)
+
+
+def test_yaml_cache_corrupt(tmp_path: Path) -> None:
+    cache_path = tmp_path / "cache.json"
+    a = tmp_path / "a.yml"
+    a.write_text("foo: 1\n")
+    for content in [
+        "not json",
+        "[]",
+        "null",
+        json.dumps({"version": roles.CACHE_VERSION, "entries": []}),
+        json.dumps({"version": roles.CACHE_VERSION, "entries": {str(a): 3}}),
+        json.dumps({"version": roles.CACHE_VERSION, "entries": {str(a): {"doc": 1}}}),
+    ]:
+        cache_path.write_text(content)
+        cache = roles.YamlCache(cache_path)
+        assert cache.load([a]) == {a: {"foo": 1}}, content
+        assert (cache.hits, cache.misses) == (0, 1), content
+
+
+def _graph(root: Path, tree: Mapping[str, Sequence[str]]) -> roles.RoleGraph:
+    for name, includes in tree.items():
+        _write_role(root, name, includes)
+    return roles.RoleGraph(roles.load_roles([str(root)], roles.YamlCache(None)))
+
+
+def test_role_graph(tmp_path: Path) -> None:
+    graph = _graph(
+        tmp_path,
+        {
+            "pi_server.a": ["pi_server.b", "pi_server.c"],
+            "pi_server.b": ["pi_server.d"],
+            "pi_server.c": ["pi_server.d", "other.role"],
+            "pi_server.d": [],
+            "pi_server.e": [],
+        },
+    )
+    assert graph.includes("pi_server.a") == {"pi_server.b", "pi_server.c"}
+    assert graph.external_includes("pi_server.c") == {"other.role"}
+    assert graph.included_by("pi_server.d") == {"pi_server.b", "pi_server.c"}
+    assert graph.descendants("pi_server.a") == {"pi_server.b", "pi_server.c", "pi_server.d"}
+    assert graph.descendants("pi_server.d") == set()
+    assert graph.ancestors("pi_server.d") == {"pi_server.a", "pi_server.b", "pi_server.c"}
+    assert graph.ancestors("pi_server.e") == set()
+
+    assert sorted(graph.order) == [
+        "pi_server.a",
+        "pi_server.b",
+        "pi_server.c",
+        "pi_server.d",
+        "pi_server.e",
+    ]
+    for name in graph.order:
+        for i in graph.includes(name):
+            assert graph.order.index(i) < graph.order.index(name)
+
+
+def test_role_graph_cycle(tmp_path: Path) -> None:
+    tree = {
+        "pi_server.a": ["pi_server.b"],
+        "pi_server.b": ["pi_server.c"],
+        "pi_server.c": ["pi_server.a"],
+    }
+    assert _verdict(lambda: _graph(tmp_path, tree)) == (
+        "Found include cycle: pi_server.a -> pi_server.b -> pi_server.c -> pi_server.a"
+    )
+    assert _verdict(lambda: _graph(tmp_path, {"pi_server.a": ["pi_server.a"]})) == (
+        "Found include cycle: pi_server.a -> pi_server.a"
+    )
+
+
+def test_lint_changed_matches_full_lint(tmp_path: Path) -> None:
+    failures = 0
+    for seed in range(10):
+        root = tmp_path / str(seed)
+        root.mkdir()
+        tree = _synthetic_tree(root, random.Random(seed))
+        _git(root, "init", "-q")
+        _git(root, "add", "-A")
+        _git(root, "commit", "-q", "-m", "base")
+
+        for name, mutate in _mutations(root, tree).items():
+            _git(root, "checkout", "-q", "--", ".")
+            _git(root, "clean", "-q", "-fd")
+            mutate()
+
+            full, changed = _lint_verdicts(root)
+            assert full == changed, f"seed {seed}, mutation '{name}'"
+            if full:
+                failures += 1
+
+    # Make sure the mutations actually exercise failing lints
+    assert failures > 0
+
+
+def test_lint_changed_skips_unaffected_roles(tmp_path: Path) -> None:
+    _write_role(tmp_path, roles.BASE_ROLE, [])
+    _write_role(tmp_path, "pi_server.apps.a", [roles.BASE_ROLE])
+    _write_role(tmp_path, "pi_server.apps.a.b", ["pi_server.apps.a"])
+    _write_role(tmp_path, "pi_server.apps.c", [roles.BASE_ROLE])
+    _git(tmp_path, "init", "-q")
+    _git(tmp_path, "add", "-A")
+    _git(tmp_path, "commit", "-q", "-m", "base")
+
+    assert roles.lint_changed([str(tmp_path)], "HEAD", roles.YamlCache(None)) == 0
+
+    (tmp_path / "pi_server.apps.a" / "templates").mkdir()
+    (tmp_path / "pi_server.apps.a" / "templates" / "foo.j2").write_text("foo")
+    assert roles.lint_changed([str(tmp_path)], "HEAD", roles.YamlCache(None)) == 2  # noqa: PLR2004
+
+
+def test_plan(tmp_path: Path) -> None:
+    shutil.copytree(HELPERS_PATH, tmp_path / roles.HELPERS_ROLE)
+    _write_role(tmp_path, roles.BASE_ROLE, [], run_once=True)
+    _write_role(tmp_path, "pi_server.apps.a", [roles.BASE_ROLE])
+    _write_role(tmp_path, "pi_server.apps.b", ["pi_server.apps.a", roles.BASE_ROLE])
+    (tmp_path / "pi_server.apps.a" / "tasks" / "tasks.yml").write_text(
+        """- ansible.builtin.include_role:
+    name: pi_server.base
+- ansible.builtin.set_fact:
+    foo: bar
+- ansible.builtin.include_tasks: extra.yml
+""",
+    )
+    (tmp_path / "pi_server.apps.a" / "tasks" / "extra.yml").write_text(
+        """- ansible.builtin.debug:
+    msg: "{{ item }}"
+  loop: [1, 2]
+""",
+    )
+
+    plan = roles.Planner(roles.load_roles([str(tmp_path)], roles.YamlCache(None))).plan(
+        "pi_server.apps.b",
+    )
+
+    assert [(i.role, i.depth, i.skipped) for i in plan] == [
+        ("pi_server.apps.b", 0, False),
+        ("pi_server.apps.a", 1, False),
+        (roles.BASE_ROLE, 2, False),
+        (roles.BASE_ROLE, 1, True),
+    ]
+    a = plan[1]
+    assert (a.own.tasks, a.own.loops, a.own.set_facts) == (4, 1, 1)
+    # Skipped roles still run define_role, but not define_role_internal
+    assert plan[3].helpers.tasks == 2  # noqa: PLR2004
+    assert plan[0].inclusive.tasks == sum(i.own.tasks + i.helpers.tasks for i in plan)
+
+
+def test_profile(tmp_path: Path) -> None:
+    shutil.copytree(HELPERS_PATH, tmp_path / roles.HELPERS_ROLE)
+    _write_role(tmp_path, roles.BASE_ROLE, [])
+    _write_role(tmp_path, "pi_server.apps.a", [roles.BASE_ROLE])
+    loaded = roles.load_roles([str(tmp_path)], roles.YamlCache(None))
+    helpers_tasks = str(tmp_path / roles.HELPERS_ROLE / "tasks" / "define_role_internal.yml")
+    a_tasks = tmp_path / "pi_server.apps.a" / "tasks"
+
+    def record(stack: list[str], path: str, start: float, end: float) -> dict[str, object]:
+        return {"host": "pi", "task": "t", "roles": stack, "path": path, "start": start, "end": end}
+
+    profile = roles.Profile(
+        loaded,
+        roles.RoleGraph(loaded),
+        [
+            record(["pi_server.apps.a"], f"{a_tasks / 'main.yml'}:1", 0, 1),
+            record(["pi_server.apps.a"], f"{helpers_tasks}:1", 1, 3),
+            record(["pi_server.apps.a"], f"{a_tasks / 'tasks.yml'}:1", 3, 7),
+            record(["pi_server.apps.a", roles.BASE_ROLE], f"{helpers_tasks}:1", 7, 15),
+            record([], "/playbook.yml:1", 15, 31),
+        ],
+    )
+
+    assert profile.own == {"pi_server.apps.a": 4, roles.Profile.PLAYBOOK: 16}
+    assert profile.helpers == {"pi_server.apps.a": 3, roles.BASE_ROLE: 8}
+    assert profile.inclusive["pi_server.apps.a"] == 15  # noqa: PLR2004
+    assert not profile.unknown_edges
+    assert profile.collapsed["pi;pi_server.apps.a;pi_server.base;[define_role];t"] == 8  # noqa: PLR2004
+
+
+def test_define_role_vars_not_cached(tmp_path: Path) -> None:
+    shutil.copytree(HELPERS_PATH, tmp_path / roles.HELPERS_ROLE)
+    _write_role(tmp_path, "pi_server.apps.a", [], run_once=True)
+    main = tmp_path / "pi_server.apps.a" / "tasks" / "main.yml"
+    main.write_text(main.read_text().replace("_args: []", "_args: [foo]"))
+    (tmp_path / "pi_server.apps.a" / "tasks" / "tasks.yml").write_text(
+        """- ansible.builtin.assert:
+    that: args.foo == 'bar'
+""",
+    )
+    playbook = tmp_path / "playbook.yml"
+    playbook.write_text(
+        """- hosts: localhost
+  gather_facts: false
+  vars:
+    pi_server_apps_a_args: from play
+  tasks:
+    - ansible.builtin.assert:
+        that:
+          - _pi_server_apps_a_done is not defined
+          - _pi_server_role_helpers_call_stack is not defined
+    - ansible.builtin.include_role:
+        name: pi_server.role_helpers
+    - ansible.builtin.include_role:
+        name: pi_server.apps.a
+      vars:
+        foo: bar
+    - ansible.builtin.assert:
+        that:
+          - _pi_server_apps_a_done
+          - pi_server_apps_a_args == {}
+          - _pi_server_role_helpers_call_stack | length == 1
+""",
+    )
+    env = {
+        **os.environ,
+        "ANSIBLE_ROLES_PATH": str(tmp_path),
+        "ANSIBLE_CACHE_PLUGIN": "jsonfile",
+        "ANSIBLE_CACHE_PLUGIN_CONNECTION": str(tmp_path / "facts"),
+    }
+
+    # The second run sees whatever the first left in the fact cache
+    for _ in range(2):
+        subprocess.run(
+            ["ansible-playbook", "-i", "localhost,", "-c", "local", str(playbook)],
+            env=env,
+            check=True,
+            capture_output=True,
+        )
+
+
+def test_stale(tmp_path: Path) -> None:
+    _write_role(tmp_path, roles.BASE_ROLE, [])
+    _write_role(tmp_path, "pi_server.apps.a", [roles.BASE_ROLE])
+    _write_role(tmp_path, "pi_server.apps.b", ["pi_server.apps.a", "pi_server.apps.c"])
+    _write_role(tmp_path, "pi_server.apps.c", [roles.BASE_ROLE])
+    _write_role(tmp_path, "pi_server.apps.d", [roles.BASE_ROLE])
+    (tmp_path / "pi_server.apps.c" / "tasks" / "tasks.yml").write_text(
+        """- ansible.builtin.set_fact:
+    foo: bar
+""",
+    )
+    state_path = tmp_path / "state.json"
+
+    def stale(host: str) -> list[str]:
+        loaded = roles.load_roles([str(tmp_path)], roles.YamlCache(None))
+        graph = roles.RoleGraph(loaded)
+        current = roles.fingerprints(loaded, graph)
+        state = roles.DeployState(state_path)
+        out = roles.stale_roles(graph, current, state.applied(host), "pi_server.apps.b")
+        state.record(host, {r: current[r] for r in out})
+        state.save()
+        return out
+
+    assert stale("pi") == [
+        roles.BASE_ROLE,
+        "pi_server.apps.a",
+        "pi_server.apps.c",
+        "pi_server.apps.b",
+    ]
+    assert stale("pi") == []
+
+    (tmp_path / "pi_server.apps.a" / "templates").mkdir()
+    (tmp_path / "pi_server.apps.a" / "templates" / "foo.j2").write_text("foo")
+    (tmp_path / "pi_server.apps.d" / "defaults").mkdir()
+    (tmp_path / "pi_server.apps.d" / "defaults" / "main.yml").write_text("foo: bar")
+    assert stale("pi") == ["pi_server.apps.a", "pi_server.apps.b"]
+    assert len(stale("pi2")) == 4  # noqa: PLR2004
+
+    loaded = roles.load_roles([str(tmp_path)], roles.YamlCache(None))
+    graph = roles.RoleGraph(loaded)
+    only = roles.only_roles(loaded, graph, "pi_server.apps.b", ["pi_server.apps.a"])
+    assert only == ["pi_server.apps.a", "pi_server.apps.c", "pi_server.apps.b"]
+    # Every role but the root is included by one that runs, so it's reached
+    for name in only[:-1]:
+        assert graph.included_by(name) & set(only)
+
+
+def test_deploy_state_corrupt(tmp_path: Path) -> None:
+    path = tmp_path / "state.json"
+    version = roles.STATE_VERSION
+    for content in [
+        "{",
+        "[]",
+        json.dumps({"version": version, "hosts": []}),
+        json.dumps({"version": version, "hosts": {"pi": 1}}),
+    ]:
+        path.write_text(content)
+        state = roles.DeployState(path)
+        assert state.applied("pi") == {}
+        state.record("pi", {"a": "1"})
+        state.save()
+        assert roles.DeployState(path).applied("pi") == {"a": "1"}
+
+
+def test_validate_include_calls(tmp_path: Path) -> None:
+    _write_role(tmp_path, roles.BASE_ROLE, [])
+    _write_role(tmp_path, "pi_server.apps.a", [roles.BASE_ROLE])
+    _write_role(tmp_path, "pi_server.apps.a.b", ["pi_server.apps.a"])
+    _write_role(tmp_path, "pi_server.apps.c", ["pi_server.apps.a"])
+    a_main = tmp_path / "pi_server.apps.a" / "tasks" / "main.yml"
+    a_main.write_text(a_main.read_text().replace("_args: []", "_args: [x, y]"))
+
+    def validate() -> str:
+        return _verdict(
+            lambda: roles.validate(roles.load_roles([str(tmp_path)], roles.YamlCache(None))),
+        )
+
+    assert validate() == (
+        "pi_server.apps.a.b calls pi_server.apps.a without args x, y\n"
+        "pi_server.apps.c calls pi_server.apps.a without args x, y"
+    )
+
+    for name in ("pi_server.apps.a.b", "pi_server.apps.c"):
+        (tmp_path / name / "tasks" / "tasks.yml").write_text(
+            """- ansible.builtin.include_role:
+    name: pi_server.apps.a
+  vars:
+    x: 1
+    y: 2
+    z: 3
+""",
+        )
+    assert validate() == ""
+
+    a_main.write_text(a_main.read_text().replace("_private: false", "_private: true"))
+    assert validate() == "pi_server.apps.a.b calls pi_server.apps.a, which is private"
+
+
+def test_vars(tmp_path: Path) -> None:
+    shutil.copytree(HELPERS_PATH, tmp_path / roles.HELPERS_ROLE)
+    _write_role(tmp_path, roles.BASE_ROLE, [])
+    _write_role(tmp_path, "pi_server.apps.a", [roles.BASE_ROLE])
+    _write_role(tmp_path, "pi_server.apps.b", ["pi_server.apps.a"])
+    a = tmp_path / "pi_server.apps.a"
+    main = a / "tasks" / "main.yml"
+    main.write_text(
+        main.read_text()
+        .replace("_export_vars: []", "_export_vars: [a_dir, a_file]")
+        .replace("_args: []", "_args: [x]"),
+    )
+    (a / "defaults").mkdir()
+    (a / "defaults" / "main.yml").write_text(
+        """a_dir: /a
+a_file: "{{ a_dir }}/file"
+a_unused: 1
+""",
+    )
+    (tmp_path / "pi_server.apps.b" / "templates").mkdir()
+    (tmp_path / "pi_server.apps.b" / "templates" / "b.j2").write_text(
+        "{{ a_file }} {{ pi_server_apps_a_args.x }}",
+    )
+
+    loaded = roles.load_roles([str(tmp_path)], roles.YamlCache(None))
+    index = roles.VarIndex(loaded, roles.YamlCache(None))
+
+    assert index.references("a_dir") == {"pi_server.apps.a"}
+    assert index.unused_exports() == [("pi_server.apps.a", "a_dir")]
+    assert index.unused_defaults() == [("pi_server.apps.a", "a_unused")]
+    footprint = index.footprint(roles.Planner(loaded).plan("pi_server.apps.b"))
+    assert footprint["roles"] == 4  # noqa: PLR2004
+    assert footprint["exports"] == 4  # noqa: PLR2004
+    assert (footprint["args"], footprint["args_read"]) == (1, 1)
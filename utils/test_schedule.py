@@ -0,0 +1,51 @@
+import itertools
+
+import schedule
+
+
+def test_vm_state_changes() -> None:
+    assert schedule.vm_state_changes(set(), []) == 0
+    assert schedule.vm_state_changes(set(), [set(), {"a"}, {"a", "b"}, set()]) == 4  # noqa: PLR2004
+    assert schedule.vm_state_changes({"a"}, [{"b"}]) == 2  # noqa: PLR2004
+
+
+def test_order_vm_states() -> None:
+    assert schedule.order_vm_states(set(), []) == []
+    assert schedule.order_vm_states(set(), [{"a", "b"}, set(), {"a"}, set()]) == [
+        frozenset(),
+        frozenset({"a"}),
+        frozenset({"a", "b"}),
+    ]
+    # Starts from whichever state is closest
+    assert schedule.order_vm_states({"a", "b"}, [set(), {"a"}, {"a", "b"}]) == [
+        frozenset({"a", "b"}),
+        frozenset({"a"}),
+        frozenset(),
+    ]
+
+
+def test_order_vm_states_fewest_changes() -> None:
+    states = [{"a"}, {"b"}, {"a", "b"}, {"c"}, {"a", "c"}, set()]
+    order = schedule.order_vm_states(set(), states)
+    assert sorted(order, key=sorted) == sorted({frozenset(s) for s in states}, key=sorted)
+    fewest = min(
+        schedule.vm_state_changes(set(), path)
+        for path in itertools.permutations({frozenset(s) for s in states})
+    )
+    assert schedule.vm_state_changes(set(), order) == fewest
+
+
+def test_order_tests() -> None:
+    tests: list[tuple[str, set[str]]] = [
+        ("m1", {"a"}),
+        ("m1", set()),
+        ("m1", {"a"}),
+        ("m2", set()),
+        ("m2", {"a"}),
+        ("m2", set()),
+        ("m1::C", {"b"}),
+        ("m1::C", set()),
+    ]
+    # Groups keep their places; m2 starts with the state m1 left
+    assert schedule.order_tests(set(), tests) == [1, 0, 2, 4, 3, 5, 7, 6]
+    assert schedule.order_tests(set(), []) == []